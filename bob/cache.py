@@ -0,0 +1,239 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+'''
+Persistent caches that let bob skip work that was already done by a
+previous run.
+'''
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from conary.lib.util import mkdirChain
+
+from bob.util import LockFile
+
+log = logging.getLogger('bob.cache')
+
+
+class DiskCache(object):
+    '''
+    Base class for caches stored as one file per key under C{cacheDir}.
+    '''
+
+    # Bump when the format of cache entries changes
+    formatVersion = 1
+
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+        self.hits = 0
+        self.misses = 0
+
+    def makeKey(self, *parts):
+        '''
+        Return a cache key derived from the string form of each of
+        C{parts}.
+        '''
+        ctx = hashlib.sha1()
+        ctx.update(str(self.formatVersion))
+        for part in parts:
+            part = str(part)
+            ctx.update('%d:%s' % (len(part), part))
+        return ctx.hexdigest()
+
+    def _getPath(self, key):
+        return os.path.join(self.cacheDir, key[:2], key)
+
+
+class RecipeCache(DiskCache):
+    '''
+    On-disk cache of the results of loading a mangled recipe, stored as
+    one JSON file per key. Entries are written atomically so several bob
+    processes may share a cache directory.
+    '''
+
+    def get(self, key):
+        '''
+        Return the data stored under C{key}, or C{None} if there is no
+        usable entry.
+        '''
+        path = self._getPath(key)
+        try:
+            with open(path) as fobj:
+                return json.load(fobj)
+        except IOError:
+            return None
+        except ValueError:
+            log.warning("Ignoring corrupt recipe cache entry %s", path)
+            return None
+
+    def put(self, key, data):
+        '''
+        Store C{data}, which must be serializable as JSON, under C{key}.
+        '''
+        path = self._getPath(key)
+        mkdirChain(os.path.dirname(path))
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path),
+                prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as fobj:
+                json.dump(data, fobj)
+            os.rename(tmpPath, path)
+        except:
+            os.unlink(tmpPath)
+            raise
+
+
+class SnapshotCache(DiskCache):
+    '''
+    On-disk cache of autosource snapshot archives. Each entry is stored
+    next to a file holding its SHA-1, which is checked before the entry
+    is used. Entries are written atomically so several bob processes may
+    share a cache directory. Call L{prune} once the cache has been used
+    to remove the least recently used entries beyond C{maxSize} bytes.
+    '''
+
+    def __init__(self, cacheDir, maxSize):
+        DiskCache.__init__(self, cacheDir)
+        self.maxSize = maxSize
+        # Entries may be fetched from several threads at once
+        self.statsLock = threading.Lock()
+
+    def _count(self, hit):
+        with self.statsLock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key, destPath):
+        '''
+        Copy the archive stored under C{key} to C{destPath}. Returns
+        C{True} if there was a valid entry, or C{False} otherwise.
+        '''
+        path = self._getPath(key)
+        try:
+            with open(path + '.sha1') as fobj:
+                expected = fobj.read().strip()
+            with open(path, 'rb') as f_in:
+                with open(destPath, 'wb') as f_out:
+                    actual = _copyWithDigest(f_in, f_out)
+        except IOError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            self._count(False)
+            return False
+        if actual != expected:
+            log.warning("Removing corrupt snapshot cache entry %s", path)
+            os.unlink(destPath)
+            self._remove(path)
+            self._count(False)
+            return False
+        # Bump the mtime, which eviction uses to find old entries.
+        try:
+            os.utime(path, None)
+        except OSError:
+            # Evicted by another process while it was being read
+            os.unlink(destPath)
+            self._count(False)
+            return False
+        self._count(True)
+        return True
+
+    def put(self, key, srcPath):
+        '''
+        Store a copy of the archive at C{srcPath} under C{key}.
+        '''
+        path = self._getPath(key)
+        mkdirChain(os.path.dirname(path))
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path),
+                prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f_out:
+                with open(srcPath, 'rb') as f_in:
+                    digest = _copyWithDigest(f_in, f_out)
+            os.rename(tmpPath, path)
+        except:
+            os.unlink(tmpPath)
+            raise
+        # The checksum goes in last so readers never see an entry without
+        # one.
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path),
+                prefix='.tmp-')
+        with os.fdopen(fd, 'w') as fobj:
+            fobj.write(digest + '\n')
+        os.rename(tmpPath, path + '.sha1')
+
+    def _remove(self, path):
+        for name in (path + '.sha1', path):
+            try:
+                os.unlink(name)
+            except OSError, err:
+                if err.errno != errno.ENOENT:
+                    raise
+
+    def prune(self):
+        '''
+        Remove the least recently used entries until the cache is no
+        larger than C{maxSize}. If another process is already pruning the
+        cache, do nothing.
+        '''
+        lock = LockFile(os.path.join(self.cacheDir, '.lock'))
+        if not lock.acquire(wait=False):
+            return
+        try:
+            entries = []
+            total = 0
+            for dirPath, _, fileNames in os.walk(self.cacheDir):
+                for name in fileNames:
+                    if name.startswith('.') or name.endswith('.sha1'):
+                        continue
+                    path = os.path.join(dirPath, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+                    total += st.st_size
+            entries.sort()
+            while entries and total > self.maxSize:
+                _, size, path = entries.pop(0)
+                log.debug("Evicting %s from snapshot cache", path)
+                self._remove(path)
+                total -= size
+        finally:
+            lock.release()
+
+
+def _copyWithDigest(f_in, f_out):
+    '''
+    Copy C{f_in} to C{f_out} and return the SHA-1 of the data as a hex
+    string.
+    '''
+    ctx = hashlib.sha1()
+    while True:
+        data = f_in.read(1024 * 1024)
+        if not data:
+            break
+        ctx.update(data)
+        f_out.write(data)
+    return ctx.hexdigest()
@@ -19,78 +19,215 @@
 Mechanism for committing bobs to a configured target repository.
 '''
 
+import httplib
 import logging
+import socket
+import threading
 import time
+from multiprocessing.pool import ThreadPool
 
 from conary.build import cook
 from conary.conaryclient import callbacks
 from conary.deps import deps
+from conary.repository import errors as repo_errors
 from conary.trove import Trove
 from rmake import compat
 from rmake.cmdline.commit import commitJobs
 
 from bob.errors import CommitFailedError
+from bob.util import ClientHelper
 
 log = logging.getLogger('bob.commit')
 
+# Number of old troves fetched at a time when applying a clone changeset
+OLD_TROVE_CHUNK_SIZE = 500
 
-def commit(helper, job):
+# Errors worth retrying a commit after, as they may go away on their own
+TRANSIENT_ERRORS = (socket.error, httplib.HTTPException,
+    repo_errors.OpenError)
+
+
+def commit(helper, job, troves=None):
+    '''
+    Commit a job to the target repository.
+
+    @param job: rMake job
+    @param troves: If given, commit only these build troves from the job.
+        All build troves of a given source must be committed together.
+    '''
+    if helper.plan.commitEngine == 'native':
+        return _old_commit(helper, job, troves)
+
+    excludeSpecs = None
+    if troves is not None:
+        keep = set(x.getName() for x in troves)
+        excludeSpecs = sorted(set((x.getName().split(':')[0], None, None)
+            for x in job.iterTroves() if x.getName() not in keep))
     ok, data = commitJobs(helper.getClient(), [job], helper.cfg.reposName,
-        message=helper.plan.commitMessage)
+        message=helper.plan.commitMessage, excludeSpecs=excludeSpecs)
     if ok:
         return data
     else:
         raise CommitFailedError(jobId=job.jobId, why=data)
 
-def _old_commit(helper, job):
+def _old_commit(helper, job, troves=None):
     '''
-    Commit a job to the target repository.
-
-    @param job: rMake job
+    Commit a job to the target repository without going through rMake.
+
+    The built troves, grouped by source, are split into chunks of about
+    C{commitChunkSize} troves, or a single chunk if that is 0. Up to
+    C{commitWorkers} chunks are in flight at once, each being cloned,
+    signed and committed by its own thread, so one chunk's clone
+    overlaps with another's commit. Each chunk is retried up to
+    C{commitRetries} times on its own if it fails with a network error
+    and did not reach the repository.
     '''
     log.info('Starting commit')
     _start_time = time.time()
 
-    okay, changeset, nbf_map = clone_job(helper, job)
+    branch_map, nbf_map = plan_clone(helper, job, troves)
+    by_source = {}
+    for (trv_name, _, trv_flavor), (trove, trv_version) \
+      in nbf_map.iteritems():
+        by_source.setdefault(trove.getName(), []).append(
+            (trv_name, trv_version, trv_flavor))
+
+    chunk_size = helper.plan.commitChunkSize
+    chunks = [[]]
+    for source_name in sorted(by_source):
+        if chunk_size > 0 and len(chunks[-1]) >= chunk_size:
+            chunks.append([])
+        chunks[-1].extend(sorted(by_source[source_name]))
+    chunks = [x for x in chunks if x]
+
+    # Each thread gets its own client, as they aren't thread-safe.
+    local = threading.local()
+    def commit_chunk(chunk):
+        if not hasattr(local, 'helper'):
+            local.helper = ClientHelper(helper.cfg, helper.plan,
+                helper.pluginMgr)
+        return _commit_chunk(local.helper, job, branch_map, nbf_map, chunk)
+
+    workers = max(min(helper.plan.commitWorkers, len(chunks)), 1)
+    log.info('Committing %d troves in %d chunks', len(nbf_map), len(chunks))
+    pool = ThreadPool(workers)
+    try:
+        results = pool.map(commit_chunk, chunks, chunksize=1)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
-    # Sanity check the resulting changeset and produce a mapping of
-    # committed versions
     mapping = {job.jobId: {}}
-    if okay:
-        for trove in iter_new_troves(changeset, helper):
-            # Make sure there are no references to the internal repos.
-            for _, child_version, _ in trove.iterTroveList(
-              strongRefs=True, weakRefs=True):
-                assert child_version.getHost() \
-                    != helper.cfg.reposName, \
-                    "Trove %s references repository" % trove
-                #assert not child_name.endswith(':testinfo'), \
-                #    "Trove %s references :testinfo component" % trove
-
-            trove_name, trove_version, trove_flavor = \
-                trove.getNameVersionFlavor()
-            trove_branch = trove_version.branch()
-            trove, _ = nbf_map[(trove_name, trove_branch, trove_flavor)]
-            trove_nvfc = trove.getNameVersionFlavor(withContext=True)
-            # map jobId -> trove -> binaries
-            mapping[trove.jobId].setdefault(trove_nvfc, []).append(
-                (trove_name, trove_version, trove_flavor))
-    else:
-        raise RuntimeError('failed to clone finished build')
-
-    if compat.ConaryVersion().signAfterPromote():
-        changeset = cook.signAbsoluteChangeset(changeset)
-    helper.getRepos().commitChangeSet(changeset)
+    for chunk_mapping in results:
+        for trove_nvfc, binaries in chunk_mapping.iteritems():
+            mapping[job.jobId].setdefault(trove_nvfc, []).extend(binaries)
 
     _finish_time = time.time()
     log.info('Commit took %.03f seconds', _finish_time - _start_time)
     return mapping
 
+def _commit_chunk(helper, job, branch_map, nbf_map, troves_to_clone):
+    '''
+    Clone and commit one chunk of a job, retrying on transient errors.
+    Returns a mapping of source trove to the binaries committed from it.
+    '''
+    attempt = 0
+    while True:
+        attempt += 1
+        mapping = None
+        try:
+            okay, changeset = clone_troves(helper, branch_map,
+                troves_to_clone)
+            if not okay:
+                raise RuntimeError('failed to clone finished build')
+            new_mapping = {}
+            for trove in iter_new_troves(changeset, helper):
+                # Make sure there are no references to the internal repos.
+                for _, child_version, _ in trove.iterTroveList(
+                  strongRefs=True, weakRefs=True):
+                    assert child_version.getHost() \
+                        != helper.cfg.reposName, \
+                        "Trove %s references repository" % trove
+
+                trove_name, trove_version, trove_flavor = \
+                    trove.getNameVersionFlavor()
+                trove_branch = trove_version.branch()
+                build_trove, _ = nbf_map[(trove_name, trove_branch,
+                    trove_flavor)]
+                trove_nvfc = build_trove.getNameVersionFlavor(
+                    withContext=True)
+                new_mapping.setdefault(trove_nvfc, []).append(
+                    (trove_name, trove_version, trove_flavor))
+
+            if compat.ConaryVersion().signAfterPromote():
+                changeset = cook.signAbsoluteChangeset(changeset)
+            mapping = new_mapping
+            helper.getRepos().commitChangeSet(changeset)
+            return mapping
+        except AssertionError:
+            raise
+        except TRANSIENT_ERRORS, err:
+            helper.configChanged()
+            if mapping is not None and _chunk_committed(helper, job,
+                    mapping, err):
+                log.warning('Commit of %d troves reported an error but '
+                    'succeeded: %s', len(troves_to_clone), err)
+                return mapping
+            if attempt > helper.plan.commitRetries:
+                log.error('Commit of %d troves failed: %s',
+                    len(troves_to_clone), err)
+                raise CommitFailedError(jobId=job.jobId, why=str(err))
+            log.warning('Commit of %d troves failed, retrying (attempt '
+                '%d of %d): %s', len(troves_to_clone), attempt + 1,
+                helper.plan.commitRetries + 1, err)
+        except Exception, err:
+            log.error('Commit of %d troves failed: %s',
+                len(troves_to_clone), err)
+            raise CommitFailedError(jobId=job.jobId, why=str(err))
+
+def _chunk_committed(helper, job, mapping, err):
+    '''
+    After a commit failed with C{err}, check whether the troves in
+    C{mapping} made it into the repository anyway. Raises
+    L{CommitFailedError} if that can't be determined, or if only some of
+    them did, since retrying would then commit them a second time.
+    '''
+    new_troves = [x for binaries in mapping.itervalues() for x in binaries]
+    try:
+        present = helper.getRepos().hasTroves(new_troves)
+    except TRANSIENT_ERRORS, check_err:
+        log.error('Commit failed (%s) and it could not be determined '
+            'whether it succeeded: %s', err, check_err)
+        raise CommitFailedError(jobId=job.jobId, why=str(err))
+    found = sum(1 for x in new_troves if present.get(x))
+    if found == len(new_troves):
+        return True
+    elif found:
+        raise CommitFailedError(jobId=job.jobId, why='%s (and %d of %d '
+            'troves were committed anyway)' % (err, found, len(new_troves)))
+    return False
+
 def clone_job(helper, job):
     '''
     Create a changeset that will clone all built troves into the target
     label.
     '''
+    branch_map, nbf_map = plan_clone(helper, job)
+    troves_to_clone = [(trv_name, trv_version, trv_flavor)
+        for (trv_name, _, trv_flavor), (trove, trv_version)
+        in nbf_map.iteritems()]
+    okay, changeset = clone_troves(helper, branch_map, troves_to_clone)
+    return okay, changeset, nbf_map
+
+def plan_clone(helper, job, troves=None):
+    '''
+    Work out which built troves to clone into the target label, dropping
+    older duplicate builds of the same name, branch and flavor.
+
+    @param troves: If given, consider only these build troves from the job.
+    @returns: A tuple C{(branch_map, nbf_map)}
+    '''
 
     branch_map = {} # source_branch -> target_branch
 
@@ -100,7 +237,9 @@ def clone_job(helper, job):
     # job.
     nbf_map = {}
 
-    for trove in job.iterTroves():
+    if troves is None:
+        troves = job.iterTroves()
+    for trove in troves:
         source_name, source_version, _ = trove.getNameVersionFlavor()
         #assert source_version.getHost() == helper.cfg.reposName
 
@@ -160,14 +299,13 @@ def clone_job(helper, job):
 
             nbf_map[nbf] = trove, bin_version
 
-    # Determine what to clone
-    troves_to_clone = []
+    return branch_map, nbf_map
 
-    for (trv_name, _, trv_flavor), (trove, trv_version) \
-      in nbf_map.iteritems():
-        troves_to_clone.append((trv_name, trv_version, trv_flavor))
-
-    # Do the clone
+def clone_troves(helper, branch_map, troves_to_clone):
+    '''
+    Create a changeset that will clone C{troves_to_clone} onto the target
+    branches given in C{branch_map}.
+    '''
     update_build_info = compat.ConaryVersion()\
         .acceptsPartialBuildReqCloning()
     callback = callbacks.CloneCallback(helper.cfg,
@@ -180,30 +318,42 @@ def clone_job(helper, job):
         callback=callback,
         #cloneOnlyByDefaultTroves=True,
         fullRecurse=False)
-    return okay, changeset, nbf_map
+    return okay, changeset
 
-def iter_new_troves(changeset, helper):
+def iter_new_troves(changeset, helper, chunk_size=OLD_TROVE_CHUNK_SIZE):
     '''
     Take a changeset and yield trove objects corresponding to the new
     versions of all troves in that changeset. This involves fetching old
     troves and applying the changeset to them to produce the new troves.
+    Old troves are fetched C{chunk_size} at a time, so only one chunk of
+    them is held in memory at once.
     '''
 
-    # First get a list of all relative trove changesets
-    old_troves = []
+    trove_css = []
     for trove_cs in changeset.iterNewTroveList():
-        if trove_cs.getOldVersion():
-            old_troves.append(trove_cs.getOldNameVersionFlavor())
+        trove_css.append(trove_cs)
+        if len(trove_css) >= chunk_size:
+            for trv in _apply_trove_chunk(trove_css, helper):
+                yield trv
+            trove_css = []
+    for trv in _apply_trove_chunk(trove_css, helper):
+        yield trv
+
+def _apply_trove_chunk(trove_css, helper):
+    '''
+    Yield new trove objects for a list of trove changesets, in order.
+    '''
 
-    # Now fetch trove objects corresponding to old versions
+    # Fetch trove objects corresponding to old versions
+    old_troves = [x.getOldNameVersionFlavor() for x in trove_css
+        if x.getOldVersion()]
     old_dict = {}
     if old_troves:
         for old_trove in helper.getRepos().getTroves(old_troves):
             old_dict.setdefault(old_trove.getNameVersionFlavor(),
                                 []).append(old_trove)
 
-    # Iterate over changeset again, yielding new trove objects
-    for trove_cs in changeset.iterNewTroveList():
+    for trove_cs in trove_css:
         if trove_cs.getOldVersion():
             trv = old_dict[trove_cs.getOldNameVersionFlavor()].pop()
             trv.applyChangeSet(trove_cs)
@@ -21,7 +21,9 @@ from conary.build.macros import Macros
 from conary.conarycfg import CfgFlavor
 from conary.lib import cfg
 from conary.lib.cfgtypes import CfgList, CfgString, CfgDict, CfgPath
-from conary.lib.cfgtypes import CfgQuotedLineList, CfgBool, ParseError
+from conary.lib.cfgtypes import CfgQuotedLineList, CfgBool, CfgInt
+from conary.lib.cfgtypes import CfgEnum
+from conary.lib.cfgtypes import ParseError
 from conary.versions import Label
 from rmake.build.buildcfg import CfgDependency
 
@@ -29,6 +31,10 @@ from rmake.build.buildcfg import CfgDependency
 DEFAULT_PATH = ['/etc/bobrc', '~/.bobrc']
 
 
+class CfgCommitEngine(CfgEnum):
+    validValues = ['rmake', 'native']
+
+
 class BobTargetSection(cfg.ConfigSection):
     '''
     Target trove configuration:
@@ -71,6 +77,12 @@ class BobConfig(cfg.SectionedConfigFile):
     scm                     = CfgDict(CfgString)    # macros supported
     refreshSources          = (CfgBool, False)
     wmsBase                 = CfgString
+    recipeLoadWorkers       = (CfgInt, 4)
+    recipeCache             = (CfgBool, False)
+    snapshotWorkers         = (CfgInt, 1)
+    snapshotWorkersPerHost  = (CfgInt, 2)
+    snapshotCacheSize       = (CfgInt, 0)
+    maxChangeSetSize        = (CfgInt, 0)
 
     # build
     installLabelPath        = CfgQuotedLineList(
@@ -82,6 +94,19 @@ class BobConfig(cfg.SectionedConfigFile):
     shortenGroupFlavors     = (CfgBool, True)
     target                  = CfgList(CfgString)
     showBuildLogs           = (CfgBool, False)
+    failFast                = (CfgBool, False)
+    incrementalCommit       = (CfgBool, False)
+    commitEngine            = (CfgCommitEngine, 'rmake')
+    commitChunkSize         = (CfgInt, 0)
+    commitWorkers           = (CfgInt, 4)
+    commitRetries           = (CfgInt, 2)
+    testWorkers             = (CfgInt, 4)
+    maxTestMessageSize      = (CfgInt, 0)
+    splitJUnit              = (CfgBool, False)
+    testHistory             = (CfgBool, False)
+    testHistoryPath         = CfgPath
+    testHistoryRuns         = (CfgInt, 10)
+    testRegressionThreshold = (CfgInt, 50)
     defaultBuildReqs        = CfgList(CfgString)
     rpmRequirements         = CfgList(CfgDependency)
 
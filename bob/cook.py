@@ -26,9 +26,11 @@ import sys
 import time
 
 from conary.build.macros import Macros
+from rmake.build import buildtrove
 from rmake.cmdline import monitor
 
 from bob import commit
+from bob import coverage
 from bob import flavors
 from bob import test
 from bob.errors import JobFailedError, TestFailureError
@@ -38,6 +40,9 @@ from bob.util import partial, pushStopHandler, popStopHandler
 
 log = logging.getLogger('bob.cook')
 
+# Minimum number of seconds between incremental commits of a running job
+INCREMENTAL_COMMIT_INTERVAL = 60
+
 
 def stopJob(batch, signum, _):
     '''
@@ -68,6 +73,36 @@ def stopJob(batch, signum, _):
     sys.exit('Signalled stop')
 
 
+class BatchDisplay(StatusOnlyDisplay):
+    '''
+    Status-only display that reports trove state changes back to the
+    batch being monitored, which can ask for monitoring to end early by
+    returning C{True}. The batch's incremental commits run from the serve
+    loop, outside of the callbacks from the rMake server.
+    '''
+
+    # R0901 - Too many ancestors
+    #pylint: disable-msg=R0901
+
+    def __init__(self, batch, *args, **kwargs):
+        StatusOnlyDisplay.__init__(self, *args, **kwargs)
+        self._batch = batch
+        self._stopped = False
+
+    def _troveStateUpdated(self, (jobId, troveTuple), state, status):
+        StatusOnlyDisplay._troveStateUpdated(self, (jobId, troveTuple),
+            state, status)
+        if self._batch.troveStateChanged(troveTuple, state):
+            self._stopped = True
+
+    def _serveLoopHook(self):
+        StatusOnlyDisplay._serveLoopHook(self)
+        self._batch.commitFinished()
+
+    def _isFinished(self):
+        return self._stopped or StatusOnlyDisplay._isFinished(self)
+
+
 class Batch(object):
     '''
     A batch of troves to be built at once; e.g. packages or groups. A
@@ -86,6 +121,15 @@ class Batch(object):
 
         # job state
         self._jobId = None
+        self._failedTroves = []
+
+        # incremental commit state
+        self._newlyBuilt = set()
+        self._committed = set()
+        self._lastCommit = 0
+        self._partialMapping = {}
+        # source name -> (testSuite, coverageData)
+        self._testResults = {}
 
         # results
         self._testSuite = None
@@ -189,42 +233,64 @@ class Batch(object):
         self._helper.callClientHook('client_preCommand2', main,
             self._helper.getrMakeHelper(), None)
         monitor.monitorJob(self._helper.getrMakeClient(), jobId,
-            exitOnFinish=True, displayClass=StatusOnlyDisplay,
+            exitOnFinish=True, displayClass=partial(BatchDisplay, self),
             showBuildLogs=self._helper.plan.showBuildLogs)
 
+        # If a trove failed and failFast is set, don't wait for the rest of
+        # the job to finish; it will never be committed anyway.
+        if self._failedTroves:
+            log.error('A trove in job %d failed; stopping the job', jobId)
+            self.stop()
+
         # Remove the signal handler now that the job is done
         self._jobId = None
         popStopHandler()
 
         # Pull out logs
         job = self._helper.getrMakeClient().getJob(jobId)
+        if self._failedTroves:
+            self.writeLogs(job, [x for x in job.iterTroves() if x.isFailed()])
+            self._logCommitted()
+            raise JobFailedError(jobId=jobId,
+                why='Trove failed and failFast is set; job stopped')
         self.writeLogs(job)
 
         # Check for error condition
         if job.isFailed():
             log.error('Job %d failed', jobId)
+            self._logCommitted()
             raise JobFailedError(jobId=jobId, why='Job failed')
         elif not job.isFinished():
             log.error('Job %d is not done, yet watch returned early!', jobId)
+            self._logCommitted()
             raise JobFailedError(jobId=jobId, why='Job not done')
         elif not list(job.iterBuiltTroves()):
             log.error('Job %d has no built troves', jobId)
             raise JobFailedError(jobId=jobId, why='Job built no troves')
 
-        # Fetch test/coverage output and report results
+        # Fetch test/coverage output and report results. Sources whose tests
+        # were already processed for an incremental commit are not fetched
+        # again.
         self._testSuite, self._coverageData = test.processTests(self._helper,
-            job)
+            job, [x for x in job.iterTroves()
+                if x.getName() not in self._testResults])
+        for name in sorted(self._testResults):
+            testSuite, coverageData = self._testResults[name]
+            self._testSuite.merge(testSuite)
+            coverage.merge(self._coverageData, coverageData)
         print 'Batch results:', self._testSuite.describe()
 
         # Bail out without committing if tests failed
         if not self._testSuite.isSuccessful():
             log.error('Some tests failed, aborting')
+            self._logCommitted()
             raise TestFailureError()
 
         # Commit to target repository
         if job.isCommitting():
             log.error('Job %d is already committing ' \
                 '(probably to the wrong place)', jobId)
+            self._logCommitted()
             raise JobFailedError(jobId=jobId, why='Job already committing')
 
         startTime = time.time()
@@ -232,7 +298,13 @@ class Batch(object):
         self._helper.getrMakeClient().startCommit([jobId])
 
         try:
-            mapping = commit.commit(self._helper, job)
+            toCommit = [x for x in job.iterTroves()
+                if x.getName() not in self._committed]
+            if toCommit:
+                mapping = commit.commit(self._helper, job, toCommit)
+            else:
+                mapping = {jobId: {}}
+            mapping[jobId].update(self._partialMapping)
         except Exception, e_value:
             self._helper.getrMakeClient().commitFailed([jobId], str(e_value))
             raise
@@ -242,6 +314,98 @@ class Batch(object):
                 jobId, time.time() - startTime)
         return mapping
 
+    def troveStateChanged(self, troveTuple, state):
+        '''
+        Called by the job monitor whenever a trove in the running job
+        changes state. Returns C{True} if monitoring should stop.
+        '''
+        if (state == buildtrove.TroveState.FAILED
+                and self._helper.plan.failFast):
+            self._failedTroves.append(troveTuple)
+            return True
+        if (state == buildtrove.TroveState.BUILT
+                and self._helper.plan.incrementalCommit):
+            # Committing is left to commitFinished, called from the
+            # monitor's serve loop.
+            self._newlyBuilt.add(troveTuple)
+        return False
+
+    def commitFinished(self):
+        '''
+        Commit packages in the running job whose build troves have all
+        finished building and whose own tests passed, if any troves have
+        built since the last attempt and at least
+        C{INCREMENTAL_COMMIT_INTERVAL} seconds have passed since then.
+
+        All build troves of a source are committed together, so that
+        duplicate binaries from different flavors of the same source are
+        resolved the same way as when committing the whole job. Errors are
+        logged and the affected troves are left for the end of the job.
+        '''
+        if not self._newlyBuilt or not self._jobId:
+            return
+        if time.time() - self._lastCommit < INCREMENTAL_COMMIT_INTERVAL:
+            return
+        self._lastCommit = time.time()
+        self._newlyBuilt = set()
+
+        try:
+            job = self._helper.getrMakeClient().getJob(self._jobId)
+        except Exception:
+            log.exception('Could not fetch job %d for an incremental commit:',
+                self._jobId)
+            return
+
+        bySource = {}
+        for trove in job.iterTroves():
+            bySource.setdefault(trove.getName(), []).append(trove)
+
+        toCommit = []
+        for name, troves in sorted(bySource.iteritems()):
+            if name in self._committed:
+                continue
+            if not all(x.isBuilt() for x in troves):
+                continue
+            if name not in self._testResults:
+                try:
+                    self._testResults[name] = test.processTests(self._helper,
+                        job, troves)
+                except Exception:
+                    log.exception('Could not process tests of %s; it will be '
+                        'committed with the rest of the job:', name)
+                    continue
+            testSuite, _ = self._testResults[name]
+            if not testSuite.isSuccessful():
+                # Leave it for the end of the job, which will fail.
+                continue
+            toCommit.extend(troves)
+        if not toCommit:
+            return
+
+        names = sorted(set(x.getName() for x in toCommit))
+        startTime = time.time()
+        log.info('Committing finished troves of job %d: %s', self._jobId,
+            ' '.join(names))
+        try:
+            mapping = commit.commit(self._helper, job, toCommit)
+        except Exception:
+            log.exception('Incremental commit failed; these troves will be '
+                'committed with the rest of the job:')
+            return
+        self._partialMapping.update(mapping[self._jobId])
+        self._committed.update(names)
+        log.info('Incremental commit completed in %.02f seconds',
+            time.time() - startTime)
+
+    def _logCommitted(self):
+        '''
+        Warn about packages that were committed incrementally before the
+        job failed.
+        '''
+        if self._committed:
+            log.warning('These packages were already committed: %s',
+                ' '.join(sorted(self._committed)))
+
     def stop(self):
         '''
         Stop the currently running build.
@@ -266,13 +430,16 @@ class Batch(object):
         '''
         return self._coverageData
 
-    def writeLogs(self, job):
+    def writeLogs(self, job, troves=None):
         """
-        Write build logs for job C{job} to the output directory.
+        Write build logs for job C{job} to the output directory. If
+        C{troves} is given, only write logs for those build troves.
         """
         jobDir = os.path.join('output', 'logs', str(job.jobId))
         client = self._helper.getrMakeClient()
-        for trv in job.iterTroves():
+        if troves is None:
+            troves = job.iterTroves()
+        for trv in troves:
             troveName = '%s{%s}' % (trv.getName(), trv.getContext())
             troveDir = os.path.join(jobDir, troveName)
             if not os.path.isdir(troveDir):
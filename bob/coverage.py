@@ -19,7 +19,10 @@
 Module containing coverage processing and reports.
 '''
 
+import __builtin__
+import binascii
 import cPickle
+import json
 import logging
 import os
 import time
@@ -27,6 +30,67 @@ import sys
 
 log = logging.getLogger('bob.coverage')
 
+# Largest line number accepted in coverage data. A bitmap costs memory in
+# proportion to its largest line, so anything bigger is assumed bogus.
+MAX_LINE = 1000000
+
+
+class LineMap(object):
+    '''
+    Immutable set of line numbers stored as a bitmap in a long integer,
+    so that intersecting and counting the lines of a file are single
+    operations on the whole map rather than on each line. Line numbers
+    above L{MAX_LINE} are rejected with C{ValueError}.
+    '''
+    __slots__ = ['bits']
+
+    def __init__(self, lines=(), bits=0L):
+        if lines:
+            if max(lines) > MAX_LINE:
+                raise ValueError("line number %r is too large" % max(lines))
+            # Build the binary digits and let long() parse them at once
+            digits = bytearray('0') * (max(lines) + 1)
+            for line in lines:
+                digits[line] = '1'
+            digits.reverse()
+            bits = long(str(digits), 2)
+        self.bits = bits
+
+    def __getstate__(self):
+        return self.bits
+
+    def __setstate__(self, bits):
+        self.bits = bits
+
+    def __and__(self, other):
+        return LineMap(bits=self.bits & other.bits)
+
+    def __eq__(self, other):
+        return isinstance(other, LineMap) and self.bits == other.bits
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __nonzero__(self):
+        return self.bits != 0
+
+    def __len__(self):
+        return bin(self.bits).count('1')
+
+    def __iter__(self):
+        digits = '%x' % self.bits
+        bitmap = bytearray(binascii.unhexlify('0' * (len(digits) % 2)
+            + digits))
+        bitmap.reverse()
+        for i, byte in enumerate(bitmap):
+            if byte:
+                for j in range(8):
+                    if byte & (1 << j):
+                        yield i * 8 + j
+
+    def __repr__(self):
+        return 'LineMap(%r)' % (list(self),)
+
 
 def process(cover_data):
     '''
@@ -53,6 +117,42 @@ def process(cover_data):
     return covered, (total_statements, total_executed)
 
 
+class SimpleReportWriter(object):
+    '''
+    Write a simple coverage report to each of C{fileobjs} one file at a
+    time. C{max_name} is the length of the longest filename to be
+    reported.
+    '''
+
+    def __init__(self, fileobjs, max_name):
+        self.fileobjs = fileobjs
+        fmt_name = "%%- %ds  " % max(5, max_name)
+        self.header = fmt_name % "Name" + " Stmts   Exec    Cover"
+        self.fmt_coverage = fmt_name + "% 6d % 6d % 7s%%"
+
+    def _write(self, line):
+        for fileobj in self.fileobjs:
+            print >>fileobj, line
+
+    def writeHeader(self):
+        self._write(self.header)
+
+    def writeFile(self, morf, num_statements, num_executed):
+        if num_statements > 0:
+            percent = 100.0 * num_executed / num_statements
+        else:
+            percent = 100.0
+        self._write(self.fmt_coverage % (morf, num_statements, num_executed,
+            '%-4.2f' % percent))
+
+    def writeTotal(self, total_statements, total_executed):
+        if total_statements > 0:
+            total_percent = 100.0 * total_executed / total_statements
+            self._write('-' * len(self.header))
+            self._write(self.fmt_coverage % ('TOTAL', total_statements,
+                total_executed, '%-4.2f' % total_percent))
+
+
 def simple_report((covered, (total_statements, total_executed)),
     dirName, fileName=None):
     '''
@@ -66,29 +166,12 @@ def simple_report((covered, (total_statements, total_executed)),
         fileobj = open(fullPath, 'w')
 
     # Print out a report
-    max_name = max([5,] + map(len, covered.keys()))
-    fmt_name = "%%- %ds  " % max_name
-    header = fmt_name % "Name" + " Stmts   Exec    Cover"
-    fmt_coverage = fmt_name + "% 6d % 6d % 7s%%"
-
-    print >>fileobj, header
+    writer = SimpleReportWriter([fileobj], max([0] + map(len, covered)))
+    writer.writeHeader()
     for morf in sorted(covered.keys()):
         num_statements, num_executed = covered[morf]
-        if num_statements > 0:
-            percent = 100.0 * num_executed / num_statements
-        else:
-            percent = 100.0
-        str_percent = '%-4.2f' % percent
-
-        print >>fileobj, fmt_coverage % (morf, num_statements,
-            num_executed, str_percent)
-
-    if total_statements > 0:
-        total_percent = 100.0 * total_executed / total_statements
-
-        print >>fileobj, '-' * len(header)
-        print >>fileobj, fmt_coverage % ('TOTAL', total_statements, total_executed,
-                              '%-4.2f' % total_percent)
+        writer.writeFile(morf, num_statements, num_executed)
+    writer.writeTotal(total_statements, total_executed)
 
 
 def wiki_summary((covered, (total_statements, total_executed)), cfg):
@@ -145,30 +228,71 @@ def dump(cover_data, dirName, fileName='pickle'):
     fullPath = dirName + os.path.sep + fileName
     fileobj = open(fullPath, 'w')
 
-    cPickle.dump(cover_data, fileobj, protocol=2)
+    # Write plain lists and sets so the pickle can be read without bob
+    cPickle.dump(dict((morf, [list(statements), set(missing)])
+        for (morf, (statements, missing)) in cover_data.iteritems()),
+        fileobj, protocol=2)
     
-def generate_reports(dirName, coverageData):
+def _packageName(morf):
+    '''Return the name of the package containing file C{morf}.'''
+    fileDir = os.path.split(morf)[0]
+    return fileDir.lstrip(os.path.sep).replace(os.path.sep, '.')
+
+
+def generate_reports(dirName, cover_data):
     """
-    Generate all the coverage reports
+    Generate all the coverage reports in a single pass over the files in
+    C{cover_data}. The simple reports are written as each file is
+    counted, while the package rollup used by the clover report and the
+    plain copy of the data used by the pickle are built alongside them.
     @param dirName: the directory to create the reports in
-    @param coverageData: a CoverageData object
+    @param cover_data: coverage data as merged by L{load} and L{merge}
+    @returns: The L{CoverageData} rollup
     """
-        
+
     # create the dir
     os.makedirs(dirName)
-    
+
+    names = sorted(cover_data)
+    coverageData = CoverageData()
+    plainData = {}
+    simpleFile = open(os.path.join(dirName, 'simple.txt'), 'w')
+    simple = SimpleReportWriter([sys.stdout, simpleFile],
+        max([0] + map(len, names)))
+    simple.writeHeader()
+
+    packageData = None
+    totals = coverageData.coverageTotalsData
+    for morf in names:
+        statements, missing = cover_data[morf]
+        numStatements = len(statements)
+        numExecuted = numStatements - len(missing)
+        simple.writeFile(morf, numStatements, numExecuted)
+        plainData[morf] = [list(statements), set(missing)]
+
+        package = _packageName(morf)
+        if packageData is None or packageData.packageName != package:
+            packageData = CoveragePackageData()
+            packageData.packageName = package
+            coverageData.addCoveragePackageData(packageData)
+        packageData.addCoverageFileData(CoverageFileData.parseCoverageFileData(
+            morf, (numStatements, numExecuted)))
+        totals.totalFiles += 1
+        totals.totalStatements += numStatements
+        totals.totalCoveredStatements += numExecuted
+
+    simple.writeTotal(totals.totalStatements, totals.totalCoveredStatements)
+    simpleFile.close()
+
     # pickle dump
-    # TODO: dump the coverage data object instead of dict?
-    dump(coverageData.pickleCoverageDict, dirName)
-    
-    # simple reports
-    # TODO: change to subclass of CoverageReport and use coverage data object
-    simple_report(coverageData.oldSchoolCoverageData, dirName)
-    simple_report(coverageData.oldSchoolCoverageData, dirName, 'simple.txt')
-    
+    with open(os.path.join(dirName, 'pickle'), 'w') as fileobj:
+        cPickle.dump(plainData, fileobj, protocol=2)
+
     # clover report
     CoverageReportClover(dirName, 'clover.xml', coverageData).writeReport()
 
+    return coverageData
+
 def clover_report((covered, (total_statements, total_executed)),
   fileobj=None):
     '''
@@ -201,9 +325,9 @@ def testGenReports():
     cov['raa/web/__init__.py'] = (254,194)
     cov['raa/web/web.py'] = (25,19)
     
-    covData =  CoverageData.parseCoverageData((cov, (150, 105)))
-    covData.pickleCoverageDict = dict(foo='bar')
-    covData.oldSchoolCoverageData = (cov, (150, 105))
+    covData = dict((morf, [LineMap(range(1, stmts + 1)),
+        LineMap(range(1, stmts - covered + 1))])
+        for (morf, (stmts, covered)) in cov.iteritems())
     generate_reports('/tmp/reports', covData)
     
 def testSimpleReport():
@@ -287,22 +411,217 @@ def gatherCloverData(covered):
         # add the last one
         packageData['files'] = packageFiles
         packageData['total'] = (pkgNumStmts, pkgNumCov)
+        projNumStmts += pkgNumStmts
+        projNumCov += pkgNumCov
         cloverData.append(packageData)
     
     return cloverData, projNumStmts, projNumCov, projNumFiles
 
+class CoverageFormatError(Exception): pass
+
+
+class _PeekedFile(object):
+    '''
+    Wrapper around a file object whose first C{size} bytes have been read
+    into C{head} to identify its format, which replays them to readers.
+    '''
+
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.head = fileobj.read(size)
+        self.buf = self.head
+
+    def read(self, size=-1):
+        if size < 0:
+            data, self.buf = self.buf + self.fileobj.read(), ''
+        elif size <= len(self.buf):
+            data, self.buf = self.buf[:size], self.buf[size:]
+        else:
+            data = self.buf + self.fileobj.read(size - len(self.buf))
+            self.buf = ''
+        return data
+
+    def readline(self):
+        if self.buf:
+            idx = self.buf.find('\n')
+            if idx >= 0:
+                data, self.buf = self.buf[:idx + 1], self.buf[idx + 1:]
+                return data
+            data, self.buf = self.buf, ''
+            return data + self.fileobj.readline()
+        return self.fileobj.readline()
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+
+# Header of the line-oriented coverage format
+LINE_FORMAT_HEADER = '# bob coverage 1'
+
+
+def _parseLines(text):
+    '''
+    Parse a comma-separated list of line numbers and ranges of line
+    numbers such as C{1-5,8,10-12}.
+    '''
+    lines = []
+    for item in text.split(','):
+        if not item:
+            continue
+        if '-' in item:
+            first, last = item.split('-')
+            if int(last) > MAX_LINE:
+                raise ValueError("line number %s is too large" % last)
+            lines.extend(xrange(int(first), int(last) + 1))
+        else:
+            lines.append(int(item))
+    return lines
+
+
+def readLineFormat(fileobj):
+    '''
+    Read the line-oriented coverage format, which after the header line
+    has one line per file of the filename, its statements and its missing
+    lines separated by tabs, e.g. C{foo/bar.py\t1-10,12\t4-5}.
+    '''
+    if not fileobj.head.startswith(LINE_FORMAT_HEADER):
+        return None
+    return _iterLineFormat(fileobj)
+
+
+def _iterLineFormat(fileobj):
+    fileobj.readline()
+    for line in fileobj:
+        line = line.rstrip('\r\n')
+        if not line or line.startswith('#'):
+            continue
+        try:
+            morf, statements, missing = line.split('\t')
+            yield morf, _parseLines(statements), _parseLines(missing)
+        except ValueError:
+            raise CoverageFormatError("Invalid coverage line: %r" % line)
+
+
+def readCoverageJSON(fileobj):
+    '''
+    Read a JSON report written by the C{coverage json} command of
+    coverage.py.
+    '''
+    if not fileobj.head.lstrip().startswith('{'):
+        return None
+    return _iterCoverageJSON(fileobj)
+
+
+def _iterCoverageJSON(fileobj):
+    try:
+        report = json.load(fileobj)
+    except ValueError, err:
+        raise CoverageFormatError("Invalid coverage JSON: %s" % err)
+    for morf, data in report.get('files', {}).iteritems():
+        missing = data.get('missing_lines', [])
+        statements = data.get('executed_lines', []) + missing
+        yield morf.encode('utf8'), statements, missing
+
+
+def readCoverageSQLite(fileobj):
+    '''
+    Reject coverage.py SQLite data files, which record only the lines
+    executed and not the statements in each file.
+    '''
+    if not fileobj.head.startswith('SQLite format 3\0'):
+        return None
+    raise CoverageFormatError("coverage.py data files do not list "
+        "statements; write a report with 'coverage json' instead")
+
+
+# Builtins that may appear in a coverage pickle
+_PICKLE_GLOBALS = set([
+    ('__builtin__', 'set'),
+    ('__builtin__', 'frozenset'),
+    ])
+
+
+def _findGlobal(module, name):
+    if (module, name) not in _PICKLE_GLOBALS:
+        raise cPickle.UnpicklingError("Global %s.%s is not allowed in "
+            "coverage data" % (module, name))
+    return getattr(__builtin__, name)
+
+
+def readPickle(fileobj):
+    '''
+    Read a pickled dictionary mapping filenames to a tuple of statements
+    and missing lines. Only sets and builtin containers are unpickled.
+    '''
+    unpickler = cPickle.Unpickler(fileobj)
+    unpickler.find_global = _findGlobal
+    try:
+        this_coverage = unpickler.load()
+    except (cPickle.UnpicklingError, EOFError, ValueError, KeyError,
+            IndexError), err:
+        raise CoverageFormatError("Invalid coverage pickle: %s" % err)
+    if not isinstance(this_coverage, dict):
+        raise CoverageFormatError("Invalid coverage pickle: expected a "
+            "dict, not %s" % type(this_coverage).__name__)
+    return ((morf, statements, missing)
+        for (morf, (statements, missing)) in this_coverage.iteritems())
+
+
+# Functions to read coverage data, tried in order. Each is given a
+# file-like object whose first bytes are available as C{head}, and
+# returns C{None} if the data is not in its format, or otherwise an
+# iterable of (filename, statements, missing lines) tuples.
+READERS = [
+    readLineFormat,
+    readCoverageJSON,
+    readCoverageSQLite,
+    readPickle,
+    ]
+
+
+def _lineMap(lines):
+    '''
+    Return a L{LineMap} of C{lines}, raising C{TypeError} or
+    C{ValueError} if they are not all line numbers, or
+    L{CoverageFormatError} if any is implausibly large.
+    '''
+    lines = list(lines)
+    if lines and min(lines) < 0:
+        raise ValueError("negative line number %r" % min(lines))
+    if lines and max(lines) > MAX_LINE:
+        raise CoverageFormatError("Invalid coverage data: line number %r "
+            "is larger than %d" % (max(lines), MAX_LINE))
+    return LineMap(lines)
+
+
 def load(cover_data, fileobj):
     '''
     Add the coverage data from one coverage blob to a "grand total"
-    dictionary.
+    dictionary, which maps each filename to a list of a L{LineMap} of
+    its statements and a L{LineMap} of its missing lines. Each file's
+    lines are converted to bitmaps as they are read, and nothing is
+    merged unless the whole blob is valid.
     '''
 
-    this_coverage = cPickle.load(fileobj)
-    for morf, (statements, missing) in this_coverage.iteritems():
-        if not cover_data.has_key(morf):
-            cover_data[morf] = [statements, set(missing)]
-        else:
-            cover_data[morf][1] &= set(missing)
+    fileobj = _PeekedFile(fileobj, 64)
+    for reader in READERS:
+        items = reader(fileobj)
+        if items is not None:
+            break
+
+    this_coverage = {}
+    try:
+        for morf, statements, missing in items:
+            if not isinstance(morf, basestring):
+                raise TypeError("filename %r is not a string" % (morf,))
+            statements, missing = _lineMap(statements), _lineMap(missing)
+            if morf in this_coverage:
+                this_coverage[morf][1] &= missing
+            else:
+                this_coverage[morf] = [statements, missing]
+    except (TypeError, ValueError, AttributeError), err:
+        raise CoverageFormatError("Invalid coverage data: %s" % err)
+    merge(cover_data, this_coverage)
 
 def merge(main, other):
     '''
@@ -453,6 +772,13 @@ class CoveragePackageData:
         if not isinstance(self.coverageFileData, list):
             self.coverageFileData = []
         self.coverageFileData.append(coverageFileData)
+        fileTotals = coverageFileData.coverageTotalsData
+        self.coverageTotalsData.totalFiles += 1
+        self.coverageTotalsData.totalStatements += fileTotals.totalStatements
+        self.coverageTotalsData.totalCoveredStatements += \
+            fileTotals.totalCoveredStatements
+        self.maxFileNameLen = max(self.maxFileNameLen,
+            len(coverageFileData.fileName))
         
     def display(self):
         """
@@ -520,6 +846,13 @@ class CoverageData:
             
             # add the file data to the package container
             pkgFileData.append({file: fileData[file]})
+
+        if lastPackage is not None:
+            # add the last one
+            cpd = CoveragePackageData.parseCoveragePackageData(
+                      lastPackage, pkgFileData)
+            cd.addCoveragePackageData(cpd)
+            totalFiles += cpd.coverageTotalsData.totalFiles
             
         # set the totals data
         ctd = CoverageTotalsData.parseCoverageTotalsData(data[1])
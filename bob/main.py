@@ -33,6 +33,7 @@ from bob import coverage
 from bob import flavors
 from bob import recurse
 from bob import shadow
+from bob import testhistory
 from bob import util
 from bob import version as bob_version
 from bob.errors import JobFailedError, TestFailureError
@@ -41,7 +42,7 @@ from bob.rev_file import RevisionFile
 from bob.scm import git
 from bob.scm import hg
 from bob.scm import wms
-from bob.test import TestSuite
+from bob.test import TestSummary
 from bob.trove import BobPackage
 from bob.util import ClientHelper, pushStopHandler, reportCommitMap
 
@@ -70,7 +71,10 @@ class BobMain(object):
         if not hasattr(self._helper.cfg, 'reposName'):
             self._helper.cfg.reposName = 'localhost'
 
-        self._testSuite = TestSuite()
+        self._testSummary = TestSummary()
+        self._durationReport = None
+        self._batchCount = 0
+        self._batchFiles = []
         self._coverageData = {}
 
     def setPlan(self, plan):
@@ -118,7 +122,11 @@ class BobMain(object):
                 os.symlink(self.bobCache, cacheDir)
                 if toDelete:
                     cny_util.rmtree(toDelete)
-            recipeFiles = repo.getRecipe(subpath)
+            if self._cfg.depMode:
+                recipeFiles = repo.getRecipe(subpath)
+            else:
+                recipeFiles = repo.getRecipe(subpath,
+                        self._helper.makeSpoolDir())
 
             package = BobPackage(sourceName, targetConfig, recipeFiles)
             package.setMangleData(mangleData)
@@ -266,12 +274,7 @@ class BobMain(object):
         if os.path.isdir('output'):
             shutil.rmtree('output')
 
-    def _writeArtifacts(self):
-        '''
-        Announce test results and write tests and coverage to disk.
-        '''
-        print self._testSuite.describe()
-
+    def _makeTestsDir(self):
         try:
             os.makedirs('output/tests')
         except OSError:
@@ -279,17 +282,69 @@ class BobMain(object):
             # bobs are run in the same directory it might have been recreated
             # already.
             pass
-        if self._testSuite.tests:
-            self._testSuite.write_junit(open('output/tests/junit.xml', 'w'))
+
+    def _writeBatchResults(self, testSuite):
+        '''
+        Write the test results of one batch to disk and add them to the
+        run's summary and duration reports, so the batch's results need
+        not be kept.
+        '''
+        self._batchCount += 1
+        self._testSummary.merge(testSuite)
+        if not testSuite.tests:
+            return
+
+        self._makeTestsDir()
+        if self._cfg.splitJUnit:
+            testSuite.write_junit_split('output/tests',
+                'batch-%d-' % self._batchCount)
+        else:
+            path = 'output/tests/batch-%d.xml' % self._batchCount
+            with open(path, 'w') as fobj:
+                testSuite.write_junit(fobj)
+            self._batchFiles.append(path)
+
+        if self._durationReport is None:
+            history = None
+            if self._cfg.testHistory:
+                path = self._cfg.testHistoryPath or os.path.join(
+                    self._helper.cfg.lookaside, self.bobCache,
+                    'test-history.sqlite')
+                history = testhistory.TestHistory(path,
+                    self._cfg.testHistoryRuns,
+                    str(self._cfg.getTargetLabel()))
+            self._durationReport = testhistory.DurationReport(history,
+                self._cfg.testRegressionThreshold)
+        self._durationReport.add(testSuite)
+
+    def _writeArtifacts(self):
+        '''
+        Announce test results and write the test reports and coverage to
+        disk.
+        '''
+        print self._testSummary.describe()
+
+        self._makeTestsDir()
+        # If only one batch had test results, keep the single junit.xml
+        # that jobs collecting the results may expect.
+        if len(self._batchFiles) == 1:
+            os.rename(self._batchFiles[0], 'output/tests/junit.xml')
+        self._batchFiles = []
+
+        report = self._durationReport
+        if report:
+            report.write('output/tests')
+            if report.history:
+                report.history.close()
+            if report.regressions:
+                log.warning('%d test runs took more than %d%% longer than '
+                    'usual; see output/tests/regressions.txt',
+                    len(report.regressions),
+                    self._cfg.testRegressionThreshold)
+            self._durationReport = None
 
         if self._coverageData:
-            report = coverage.process(self._coverageData)
-            # build the coverage data objects
-            cdo = coverage.CoverageData.parseCoverageData(report)
-            # TODO: merge pickle/old school data into coverage data obj
-            cdo.pickleCoverageDict = self._coverageData
-            cdo.oldSchoolCoverageData = report
-            coverage.generate_reports('output/coverage', cdo)
+            coverage.generate_reports('output/coverage', self._coverageData)
 
     def _cleanup(self):
         if self._wmsToken:
@@ -301,6 +356,7 @@ class BobMain(object):
             return self._run()
         finally:
             self._helper.cleanupEphemeralDir()
+            self._helper.cleanupSpoolDir()
 
     def _run(self):
         '''
@@ -326,7 +382,7 @@ class BobMain(object):
                 self._cleanup()
                 return 2
             except TestFailureError:
-                self._testSuite.merge(batch.getTestSuite())
+                self._writeBatchResults(batch.getTestSuite())
                 coverage.merge(self._coverageData, batch.getCoverageData())
 
                 # We need to write out the test results early since
@@ -336,7 +392,7 @@ class BobMain(object):
                 self._cleanup()
                 return 0
             else:
-                self._testSuite.merge(batch.getTestSuite())
+                self._writeBatchResults(batch.getTestSuite())
                 coverage.merge(self._coverageData, batch.getCoverageData())
                 util.insertResolveTroves(self._helper.cfg, newTroves)
                 commitMap.update(newTroves)
@@ -15,8 +15,14 @@
 #
 
 import os
+import shutil
 import tempfile
 from conary.lib import util
+from conary.repository import filecontents
+
+# Files in a source tree larger than this are left on disk instead of being
+# read into memory.
+MAX_INMEMORY_SIZE = 1024 * 1024
 
 
 class ScmRepository(object):
@@ -36,8 +42,12 @@ class ScmRepository(object):
         """Refresh the local cache for the repository"""
         raise NotImplementedError
 
-    def getRecipe(self, subpath):
-        """Return a dictionary of file contents at the given subpath"""
+    def getRecipe(self, subpath, spoolDir=None):
+        """
+        Return a dictionary of file contents at the given subpath. If
+        C{spoolDir} is given, large files are moved there and returned as
+        C{FromFilesystem} content objects instead of strings.
+        """
         assert self.revision
         # Update the local repository cache.
         workDir = tempfile.mkdtemp()
@@ -50,12 +60,27 @@ class ScmRepository(object):
                         "sourceTree %s does not exist or is not a directory" %
                         subpath)
             files = {}
+            # Spooled files by the real path they were moved from, so that
+            # several names for one file share a single spooled copy.
+            spooled = {}
             for name in os.listdir(subDir):
                 filePath = os.path.realpath(os.path.join(subDir, name))
                 if not filePath.startswith(workDir):
                     raise RuntimeError(
                             "Illegal symlink %s points outside checkout: %s"
                             % (os.path.join(subpath, name), filePath))
+                if filePath in spooled:
+                    files[name] = filecontents.FromFilesystem(
+                            spooled[filePath])
+                    continue
+                if (spoolDir and not name.endswith('.recipe')
+                        and os.path.getsize(filePath) > MAX_INMEMORY_SIZE):
+                    fd, spoolPath = tempfile.mkstemp(dir=spoolDir)
+                    os.close(fd)
+                    shutil.move(filePath, spoolPath)
+                    spooled[filePath] = spoolPath
+                    files[name] = filecontents.FromFilesystem(spoolPath)
+                    continue
                 with open(filePath, 'rb') as fobj:
                     files[name] = fobj.read()
             return files
@@ -21,10 +21,18 @@ Tools for manipulating recipes and source troves.
 
 import hashlib
 import inspect
+import json
 import logging
+import multiprocessing
 import os
+import re
 import shutil
+import sys
 import tempfile
+import threading
+import urlparse
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
 from conary.build import cook
 from conary.build import lookaside
@@ -32,10 +40,11 @@ from conary.build import grouprecipe
 from conary.build import recipe as cny_recipe
 from conary.build import use
 from conary.build.loadrecipe import RecipeLoader
-from conary.build.loadrecipe import RecipeLoaderFromSourceDirectory
+from conary.build.loadrecipe import RecipeLoaderFromSourceTrove
 from conary.build.lookaside import RepositoryCache
 from conary.changelog import ChangeLog
 from conary.conaryclient import filetypes
+from conary.conaryclient.cmdline import parseTroveSpec
 from conary.deps import deps
 from conary.files import FileFromFilesystem, ThawFile
 from conary.lib.util import mkdirChain, joinPaths
@@ -46,8 +55,9 @@ from conary.trove import Trove
 from conary.versions import Branch, Revision
 
 from bob import macro
+from bob.cache import RecipeCache, SnapshotCache
 from bob.mangle import mangle
-from bob.util import checkBZ2
+from bob.util import ClientHelper, checkBZ2, resetStopHandlers
 
 log = logging.getLogger('bob.shadow')
 
@@ -55,15 +65,67 @@ log = logging.getLogger('bob.shadow')
     SP_FIND_OLD, SP_GET_OLD, SP_DONE) = range(6)
 
 
+# Calls that load another recipe, and the string naming it if it is a literal
+_re_loadRecipe = re.compile(
+        r'''\bload(?:SuperClass|Installed)\s*\(\s*(?:(['"])(.*?)\1)?''')
+
+
+class RecipeInfo(object):
+    '''
+    The parts of a loaded recipe that are needed to shadow it: the
+    upstream version, and the path, ephemeral flag and "inline contents"
+    flag of each source action. Unlike the recipe object this can be
+    pickled, so it can be produced by a worker process.
+
+    C{loadedSpecs} lists the superclasses the recipe loaded, as
+    C{(troveSpec, name, frozenVersion)} tuples.
+    '''
+
+    def __init__(self, version, sources=(), loadedSpecs=()):
+        self.version = version
+        self.sources = [tuple(x) for x in sources]
+        self.loadedSpecs = [tuple(x) for x in loadedSpecs]
+
+    @classmethod
+    def fromRecipe(cls, recipeObj, loadedSpecs=()):
+        # Unknown recipe types will not be loaded so recipeObj will be the
+        # class, so assume these have no sources.
+        if inspect.isclass(recipeObj):
+            return cls(recipeObj.version, loadedSpecs=loadedSpecs)
+        sources = []
+        for source in recipeObj.getSourcePathList():
+            inline = bool(getattr(source, 'contents', None)
+                    and not source.sourcename)
+            sources.append((source.getPath(), bool(source.ephemeral), inline))
+        return cls(recipeObj.version, sources, loadedSpecs)
+
+    @classmethod
+    def thaw(cls, data):
+        sources = [(str(path), ephemeral, inline)
+                for (path, ephemeral, inline) in data['sources']]
+        loadedSpecs = [tuple(str(x) for x in spec)
+                for spec in data['loadedSpecs']]
+        return cls(str(data['version']), sources, loadedSpecs)
+
+    def freeze(self):
+        return dict(version=self.version, sources=self.sources,
+                loadedSpecs=self.loadedSpecs)
+
+
 class ShadowBatch(object):
     def __init__(self, helper):
         self.helper = helper
         self.sources = set()
         self.oldChangeSet = None
+        self.oldSHA1s = {}
+        self.recipeDir = None
+        self.labelVersions = {}
 
-        # Parallel lists
+        # Parallel lists. Recipe objects are None until loaded in this
+        # process; see _getRecipeObject.
         self.packages = []
         self.recipes = []
+        self.recipeInfo = []
         self.oldTroves = []
 
     def addPackage(self, package):
@@ -78,34 +140,251 @@ class ShadowBatch(object):
 
         self._makeProddef()
         self._makePlatdef()
-        self._makeRecipes()
-        if self.helper.plan.depMode:
-            return
-        self._fetchOldChangeSets()
-        self._merge()
+        try:
+            self._makeRecipes()
+            if self.helper.plan.depMode:
+                return
+            self._fetchOldChangeSets()
+            self._merge()
+        finally:
+            if self.recipeDir and not self.helper.plan.dumpRecipes:
+                shutil.rmtree(self.recipeDir)
+            self.recipeDir = None
 
     def _makeRecipes(self):
         """Take pristine upstream sources, mangle them, and load the result."""
         if self.helper.plan.dumpRecipes:
-            recipeDir = self.helper.plan.recipeDir
+            self.recipeDir = self.helper.plan.recipeDir
         else:
-            recipeDir = tempfile.mkdtemp(prefix='bob-')
+            self.recipeDir = tempfile.mkdtemp(prefix='bob-')
         # Dump all the recipes out at once in case they have interdependencies
         finalRecipes = []
+        recipePaths = []
         for package in self.packages:
             recipe = package.getRecipe()
             finalRecipe = mangle(package, recipe)
             package.recipeFiles[package.getRecipeName()] = finalRecipe
-            with open(os.path.join(recipeDir, package.getRecipeName()
-                    ), 'w') as fobj:
+            recipePath = os.path.join(self.recipeDir, package.getRecipeName())
+            with open(recipePath, 'w') as fobj:
                 fobj.write(finalRecipe)
             finalRecipes.append(finalRecipe)
+            recipePaths.append(recipePath)
+
+        # Dependency analysis needs the actual recipe objects, so always load
+        # those in-process.
+        if self.helper.plan.depMode:
+            for package, finalRecipe, recipePath in zip(self.packages,
+                    finalRecipes, recipePaths):
+                recipeObj = _loadRecipe(self.helper, package, recipePath)
+                self.recipes.append((finalRecipe, recipeObj))
+                self.recipeInfo.append(RecipeInfo.fromRecipe(recipeObj))
+            return
+
+        self.recipes = [(x, None) for x in finalRecipes]
+        self.recipeInfo = [None] * len(self.packages)
+        cache = None
+        keys = entries = [None] * len(self.packages)
+        extraSpecs = set()
+        if self.helper.plan.recipeCache:
+            cache = RecipeCache(os.path.join(self.helper.cfg.lookaside,
+                '__bob__', 'recipes'))
+            keys, entries = self._readRecipeCache(cache, finalRecipes)
+            extraSpecs.update(self.helper.cfg.autoLoadRecipes)
+            for entry in entries:
+                if entry:
+                    extraSpecs.update(x[0] for x in entry['loadedSpecs'])
+
+        # Everything else the shadow phase needs from the repository is
+        # looked up here, in one query.
+        resolved = self._queryRepository(sorted(extraSpecs))
+        if cache:
+            autoLoad = self._checkRecipeCache(cache, keys, entries, resolved)
+
+        toLoad = [i for i, x in enumerate(self.recipeInfo) if x is None]
+        existingVersions = [self._existingVersions(x) for x in self.packages]
+
+        def loadInProcess(indices):
+            for idx in indices:
+                loadedSpecs = []
+                recipeObj = _loadRecipe(self.helper, self.packages[idx],
+                        recipePaths[idx], loadedSpecs, existingVersions[idx])
+                self.recipes[idx] = (finalRecipes[idx], recipeObj)
+                self.recipeInfo[idx] = RecipeInfo.fromRecipe(recipeObj,
+                        loadedSpecs)
+
+        # Packages that will have their autosources fetched need the recipe
+        # object itself later on, which can't be passed back from a worker.
+        # Load those here, while the pool loads the rest, rather than
+        # loading them twice.
+        inProcess = [x for x in toLoad if self._willFetchSources(x)]
+        inPool = sorted(set(toLoad) - set(inProcess))
+        workers = self.helper.plan.recipeLoadWorkers
+        if workers <= 1 or len(inPool) < 2:
+            loadInProcess(toLoad)
+        else:
+            infos = _loadRecipesParallel(self.helper,
+                    [self.packages[x] for x in inPool],
+                    [recipePaths[x] for x in inPool],
+                    [existingVersions[x] for x in inPool], workers,
+                    whileWaiting=lambda: loadInProcess(inProcess))
+            for idx, info in zip(inPool, infos):
+                self.recipeInfo[idx] = info
+
+        if cache:
+            for idx in toLoad:
+                if keys[idx] is None:
+                    continue
+                data = self.recipeInfo[idx].freeze()
+                data['autoLoad'] = autoLoad
+                cache.put(keys[idx], data)
+            log.info("Recipe cache: %d hits, %d misses", cache.hits,
+                    cache.misses)
+
+    def _readRecipeCache(self, cache, finalRecipes):
+        """
+        Return the cache key (C{None} if the package can't be cached) and
+        cache entry (C{None} if there isn't one) for each package.
+        """
+        cfg = self.helper.cfg
+        macros = sorted(cfg.macros.items())
+        keys = []
+        entries = []
         for package, finalRecipe in zip(self.packages, finalRecipes):
+            if package.targetConfig.factory not in ('', 'factory'):
+                # Factory recipes are loaded through a temporary source
+                # trove, so their result depends on more than the recipe.
+                keys.append(None)
+                entries.append(None)
+                continue
+            localRecipes = self._localSuperClasses(finalRecipe)
+            if localRecipes is None:
+                keys.append(None)
+                entries.append(None)
+                continue
+            key = cache.makeKey(package.getName(), finalRecipe,
+                    cfg.buildFlavor, macros, self.helper.plan.getTargetLabel(),
+                    localRecipes)
+            keys.append(key)
+            entries.append(cache.get(key))
+        return keys, entries
+
+    def _localSuperClasses(self, recipe):
+        """
+        Return C{(name, contents)} for each recipe in C{recipeDir} that
+        C{recipe} may load, directly or through another local recipe. These
+        are loaded from disk rather than the repository, so their versions
+        are not in the loaded specs. Returns C{None} if a recipe is named by
+        an expression instead of a string, as it can't be known which.
+        """
+        recipeDir = self.helper.plan.recipeDir
+        if not recipeDir:
+            return []
+        found = {}
+        toScan = [recipe]
+        while toScan:
+            for quote, spec in _re_loadRecipe.findall(toScan.pop()):
+                if not quote:
+                    return None
+                name = re.split(r'[=:\[]', spec, 1)[0]
+                if name in found:
+                    continue
+                try:
+                    with open(os.path.join(recipeDir,
+                            name + '.recipe')) as fobj:
+                        found[name] = fobj.read()
+                except IOError:
+                    # Loaded from the repository instead
+                    found[name] = None
+                    continue
+                toScan.append(found[name])
+        return sorted((name, contents)
+                for (name, contents) in found.iteritems()
+                if contents is not None)
+
+    def _checkRecipeCache(self, cache, keys, entries, resolved):
+        """
+        Fill in recipe info for each package that has a usable cache entry.
+        An entry is only used if the superclasses and autoloaded recipes it
+        was loaded with are still the latest matches for their trove specs.
+
+        Returns the current autoload state to store with new entries.
+        """
+        # Normalize through JSON so it compares equal to the stored copy.
+        autoLoad = json.loads(json.dumps([(x, resolved.get(x, []))
+            for x in sorted(self.helper.cfg.autoLoadRecipes)]))
+
+        for idx, entry in enumerate(entries):
+            if keys[idx] is None:
+                continue
+            if (entry and entry.get('autoLoad') == autoLoad
+                    and all((name, version) in resolved.get(spec, ())
+                        for (spec, name, version) in entry['loadedSpecs'])):
+                self.recipeInfo[idx] = RecipeInfo.thaw(entry)
+                cache.hits += 1
+            else:
+                cache.misses += 1
+        return autoLoad
+
+    def _queryRepository(self, extraSpecs):
+        """
+        Look up everything the shadow phase needs from the repository with
+        a single C{findTroves} call: every version of each package on the
+        target label, including removed ones, plus the trove specs in
+        C{extraSpecs}, which are resolved against the build label path.
+
+        The versions on the target label are stored in C{labelVersions}.
+        Returns a map of each extra spec to the C{(name, frozenVersion)}
+        pairs of its latest matches.
+        """
+        cfg = self.helper.cfg
+        targetLabel = str(self.helper.plan.getTargetLabel())
+        labelSpecs = [(x.getName(), targetLabel, None) for x in self.packages]
+        extraTroveSpecs = [parseTroveSpec(x) for x in extraSpecs]
+        labelPath = [cfg.buildLabel] + list(cfg.installLabelPath or [])
+        results = self.helper.getRepos().findTroves(labelPath,
+                labelSpecs + extraTroveSpecs, allowMissing=True,
+                getLeaves=False, troveTypes=trovesource.TROVE_QUERY_ALL)
+
+        for package, spec in zip(self.packages, labelSpecs):
+            self.labelVersions[package.getName()] = results.get(spec, [])
+        resolved = {}
+        for spec, troveSpec in zip(extraSpecs, extraTroveSpecs):
+            matches = results.get(troveSpec, ())
+            if not matches:
+                continue
+            latest = max(x[1] for x in matches)
+            resolved[spec] = sorted(set((n, v.freeze())
+                for (n, v, f) in matches if v == latest))
+        return resolved
+
+    def _existingVersions(self, package):
+        """
+        Return the versions of I{package} already on the target label.
+        """
+        return [x[1] for x in self.labelVersions[package.getName()]]
+
+    def _willFetchSources(self, idx):
+        """
+        Return C{True} if the I{idx}th package is sure to have its
+        autosources fetched, because sources are being refreshed or the
+        package is not on the target label yet.
+        """
+        return (self.helper.plan.refreshSources
+                or not self.labelVersions[self.packages[idx].getName()])
+
+    def _getRecipeObject(self, idx):
+        """
+        Return the recipe object for the I{idx}th package, loading it now if
+        it was only loaded in a worker process or taken from the cache.
+        """
+        finalRecipe, recipeObj = self.recipes[idx]
+        if recipeObj is None:
+            package = self.packages[idx]
             recipeObj = _loadRecipe(self.helper, package,
-                    os.path.join(recipeDir, package.getRecipeName()))
-            self.recipes.append((finalRecipe, recipeObj))
-        if not self.helper.plan.dumpRecipes:
-            shutil.rmtree(recipeDir)
+                    os.path.join(self.recipeDir, package.getRecipeName()),
+                    existingVersions=self._existingVersions(package))
+            self.recipes[idx] = (finalRecipe, recipeObj)
+        return recipeObj
 
     def _makeProddef(self):
         pkg = self._getProddefPackage()
@@ -113,7 +392,7 @@ class ShadowBatch(object):
             return
 
         fname = 'product-definition.xml'
-        proddef = pkg.recipeFiles.get(fname)
+        proddef = pkg.getFileContents(fname)
         finalProddef = proddef % pkg.getMangleData().get('macros')
         pkg.recipeFiles[fname] = finalProddef
 
@@ -131,7 +410,7 @@ class ShadowBatch(object):
         platDefs = [ x for x in pkg.recipeFiles if
                         x.startswith('plat') and x.endswith('xml') ]
         for fname in platDefs:
-            platdef = pkg.recipeFiles.get(fname)
+            platdef = pkg.getFileContents(fname)
             finalPlatdef = platdef % pkg.getMangleData().get('macros')
             pkg.recipeFiles[fname] = finalPlatdef
 
@@ -147,53 +426,63 @@ class ShadowBatch(object):
         Fetch old versions of each trove, where they can be found
         and are suitably sane.
         """
-        versionSpecs = []
-        latestSpecs = []
-        targetLabel = self.helper.plan.getTargetLabel()
-        for package in self.packages:
-            version = macro.expand(package.getBaseVersion(), package)
-            versionSpecs.append((package.getName(),
-                '%s/%s' % (targetLabel, version), None))
-            latestSpecs.append((package.getName(), str(targetLabel), None))
-
-        # Pick the new version for each package by querying all existing
-        # versions (including markremoved ones) with the same version.
-        results = self.helper.getRepos().findTroves(None, versionSpecs,
-            allowMissing=True, getLeaves=False,
-            troveTypes=trovesource.TROVE_QUERY_ALL)
-        for package, (recipeText, recipeObj), query in zip(
-                self.packages, self.recipes, versionSpecs):
-            newVersion = _createVersion(package, self.helper,
-                    recipeObj.version)
-            existingVersions = [x[1] for x in results.get(query, ())]
+        toGet = []
+        oldVersions = []
+        for package, info in zip(self.packages, self.recipeInfo):
+            # Pick the new version for each package by checking all existing
+            # versions (including markremoved ones) on the target label.
+            existing = self.labelVersions[package.getName()]
+            newVersion = _createVersion(package, self.helper, info.version)
+            existingVersions = [x[1] for x in existing]
             while newVersion in existingVersions:
                 newVersion.incrementSourceCount()
             package.nextVersion = newVersion
-        # Grab the latest existing version so we can reuse autosources from it
-        results = self.helper.getRepos().findTroves(None, latestSpecs,
-                allowMissing=True)
-        toGet = []
-        oldVersions = []
-        for package, query in zip(self.packages, latestSpecs):
-            if not results.get(query):
+
+            # Grab the latest existing version so we can reuse autosources
+            # from it
+            if not existing:
                 oldVersions.append(None)
                 continue
-            n, v, f = max(results[query])
+            n, v, f = max(existing)
             toGet.append((n, (None, None), (v, f), True))
             oldVersions.append((n, v, f))
 
         self.oldChangeSet = self.helper.createChangeSet(toGet)
-        for package, oldVersion in zip(self.packages, oldVersions):
+        oldTroves = []
+        for oldVersion in oldVersions:
             if oldVersion:
                 trvCs = self.oldChangeSet.getNewTroveVersion(*oldVersion)
-                self.oldTroves.append(Trove(trvCs))
+                oldTroves.append(Trove(trvCs))
             else:
-                self.oldTroves.append(None)
+                oldTroves.append(None)
+
+        # The latest version on the label might have been markremoved, in
+        # which case go back to asking for the latest present version.
+        removed = [i for i, x in enumerate(oldTroves) if x and x.isRemoved()]
+        if removed:
+            latestSpecs = [(oldVersions[i][0], oldVersions[i][1].trailingLabel(
+                ).asString(), None) for i in removed]
+            results = self.helper.getRepos().findTroves(None, latestSpecs,
+                    allowMissing=True)
+            for idx, query in zip(removed, latestSpecs):
+                if results.get(query):
+                    oldVersions[idx] = max(results[query])
+                else:
+                    oldVersions[idx] = None
+            toGet = [(x[0], (None, None), (x[1], x[2]), True)
+                    for x in oldVersions if x]
+            self.oldChangeSet = self.helper.createChangeSet(toGet)
+            for idx in removed:
+                if oldVersions[idx]:
+                    trvCs = self.oldChangeSet.getNewTroveVersion(
+                            *oldVersions[idx])
+                    oldTroves[idx] = Trove(trvCs)
+                else:
+                    oldTroves[idx] = None
+        self.oldTroves = oldTroves
 
     def _merge(self):
-        changeSet = ChangeSet()
         deleteDirs = set()
-        doCommit = False
         # If this is not None then all ephemeral sources will still be fetched
         # but will be placed in this directory instead.
         if self.helper.plan.ephemeralSourceDir:
@@ -201,6 +490,63 @@ class ShadowBatch(object):
         else:
             ephDir = None
 
+        # Auto sources are fetched in the background as each package's needs
+        # are worked out. The troves are then assembled in package order,
+        # each one as soon as its own snapshots are ready, so hashing
+        # earlier packages overlaps with downloading later ones.
+        snapshotCache = None
+        if self.helper.plan.snapshotCacheSize > 0:
+            snapshotCache = SnapshotCache(os.path.join(
+                self.helper.cfg.lookaside, '__bob__', 'snapshots'),
+                self.helper.plan.snapshotCacheSize * 1024 * 1024)
+        fetcher = SnapshotFetcher(self.helper, snapshotCache)
+        try:
+            self._assemble(fetcher, ephDir, deleteDirs)
+        finally:
+            fetcher.close()
+            if snapshotCache:
+                snapshotCache.prune()
+        if snapshotCache and (snapshotCache.hits or snapshotCache.misses):
+            log.info("Snapshot cache: %d hits, %d misses",
+                    snapshotCache.hits, snapshotCache.misses)
+
+        for path in deleteDirs:
+            shutil.rmtree(path)
+
+    def _commit(self, changeSet):
+        cook.signAbsoluteChangesetByConfig(changeSet, self.helper.cfg)
+        try:
+            self.helper.getRepos().commitChangeSet(changeSet)
+        except:
+            # Only write the changeset out if it's needed for a retry;
+            # the file contents can still be read back from their
+            # original locations.
+            e_type, e_value, e_tb = sys.exc_info()
+            try:
+                f = tempfile.NamedTemporaryFile(dir=os.getcwd(),
+                        suffix='.ccs', delete=False)
+                f.close()
+                changeSet.writeToFile(f.name)
+            except:
+                log.exception("Error committing changeset to "
+                        "repository, and the failed changeset could not "
+                        "be saved:")
+            else:
+                log.error("Error committing changeset to repository, "
+                        "failed changeset is saved at %s", f.name)
+            raise e_type, e_value, e_tb
+
+    def _assemble(self, fetcher, ephDir, deleteDirs):
+        """
+        Build the new source trove for each package and commit it, unless
+        it is identical to the old one. If C{maxChangeSetSize} is set, the
+        troves are committed in several changesets of about that size.
+        """
+        maxSize = self.helper.plan.maxChangeSetSize * 1024 * 1024
+        changeSet = ChangeSet()
+        changeSetSize = changeSetTroves = 0
+        pending = []
+
         def _addFile(path, contents, isText):
             if path in oldFiles:
                 # Always recycle pathId if available.
@@ -224,8 +570,8 @@ class ShadowBatch(object):
             filesToAdd[fileId] = (fileStream, fileHelper.contents, isText)
             newTrove.addFile(pathId, path, fileVersion, fileId)
 
-        for package, (recipeText, recipeObj), oldTrove in zip(
-                self.packages, self.recipes, self.oldTroves):
+        for idx, (package, info, oldTrove) in enumerate(zip(
+                self.packages, self.recipeInfo, self.oldTroves)):
 
             filesToAdd = {}
             oldFiles = {}
@@ -234,6 +580,9 @@ class ShadowBatch(object):
                     oldFiles[path] = (pathId, path, fileId, fileVer)
             newTrove = Trove(package.name, package.nextVersion, deps.Flavor())
             newTrove.setFactory(package.targetConfig.factory)
+            snapshots = []
+            pending.append((package, oldTrove, newTrove, filesToAdd,
+                snapshots))
 
             # Add upstream files to new trove. Recycle pathids from the old
             # version.
@@ -243,38 +592,40 @@ class ShadowBatch(object):
                 isText = path == package.getRecipeName()
                 _addFile(path, contents, isText)
 
-            # Collect requested auto sources from recipe. Unknown recipe types
-            # will not be loaded so recipeObj will be the class, so assume
-            # these have no sources.
-            if not inspect.isclass(recipeObj):
-                recipeFiles = dict((os.path.basename(x.getPath()), x)
-                    for x in recipeObj.getSourcePathList())
+            # Collect requested auto sources from recipe.
+            if info.sources:
+                recipeFiles = dict((os.path.basename(x[0]), x)
+                    for x in info.sources)
                 newFiles = set(x[1] for x in newTrove.iterFileList())
 
                 needFiles = set(recipeFiles) - newFiles
-                for autoPath in needFiles:
-                    source = recipeFiles[autoPath]
-                    if getattr(source, 'contents', None
-                            ) and not source.sourcename:
+                for autoPath in sorted(needFiles):
+                    sourcePath, ephemeral, inline = recipeFiles[autoPath]
+                    if inline:
                         # Ignore trove scripts that have inline contents
                         continue
                     if not autoPath:
                         log.error("bob does not support 'gussed' filenames; "
                                 "please use a full path for source '%s' in "
-                                "package %s", source.getPath(), package.name)
+                                "package %s", sourcePath, package.name)
                         raise RuntimeError("Unsupported source action")
                     if (autoPath in oldFiles
                             and not self.helper.plan.refreshSources
-                            and not source.ephemeral):
+                            and not ephemeral):
                         # File exists in old version.
                         pathId, path, fileId, fileVer = oldFiles[autoPath]
                         newTrove.addFile(pathId, path, fileVer, fileId)
                         continue
 
-                    if source.ephemeral and not ephDir:
+                    if ephemeral and not ephDir:
                         continue
 
-                    # File doesn't exist; need to create it.
+                    # File doesn't exist; need to create it. That takes the
+                    # real source action, so the recipe must be loaded here.
+                    recipeObj = self._getRecipeObject(idx)
+                    sourceActions = dict((os.path.basename(x.getPath()), x)
+                        for x in recipeObj.getSourcePathList())
+                    source = sourceActions[autoPath]
                     if source.ephemeral:
                         laUrl = lookaside.laUrl(source.getPath())
                         tempDir = joinPaths(ephDir,
@@ -283,29 +634,44 @@ class ShadowBatch(object):
                     else:
                         tempDir = tempfile.mkdtemp()
                         deleteDirs.add(tempDir)
-                    snapshot = _getSnapshot(self.helper, package, source,
-                            tempDir)
-
-                    if not source.ephemeral and snapshot:
-                        autoPathId = hashlib.md5(autoPath).digest()
-                        autoObj = FileFromFilesystem(snapshot, autoPathId)
-                        autoObj.flags.isAutoSource(set=True)
-                        autoObj.flags.isSource(set=True)
-                        autoFileId = autoObj.fileId()
-
-                        autoContents = filecontents.FromFilesystem(snapshot)
-                        filesToAdd[autoFileId] = (autoObj, autoContents, False)
-                        newTrove.addFile(autoPathId, autoPath,
-                            newTrove.getVersion(), autoFileId)
+                    snapshots.append((autoPath, source,
+                        fetcher.submit(package, source, tempDir)))
+
+        for package, oldTrove, newTrove, filesToAdd, snapshots in pending:
+            for autoPath, source, result in snapshots:
+                snapshot = result.get()
+                if not source.ephemeral and snapshot:
+                    autoPathId = hashlib.md5(autoPath).digest()
+                    autoObj = FileFromFilesystem(snapshot, autoPathId)
+                    autoObj.flags.isAutoSource(set=True)
+                    autoObj.flags.isSource(set=True)
+                    autoFileId = autoObj.fileId()
+
+                    autoContents = filecontents.FromFilesystem(snapshot)
+                    filesToAdd[autoFileId] = (autoObj, autoContents, False)
+                    newTrove.addFile(autoPathId, autoPath,
+                        newTrove.getVersion(), autoFileId)
 
             # If the old and new troves are identical, just use the old one.
-            if oldTrove and _sourcesIdentical(
-                    oldTrove, newTrove, [self.oldChangeSet, filesToAdd]):
+            if oldTrove and _sourcesIdentical(oldTrove, newTrove,
+                    self.oldChangeSet, self.oldSHA1s, filesToAdd):
                 package.setDownstreamVersion(oldTrove.getVersion())
                 log.debug('Skipped %s=%s', oldTrove.getName(),
                         oldTrove.getVersion())
                 continue
 
+            # Start a new changeset if this package would push the current
+            # one over the size limit.
+            troveSize = sum(x[0].contents.size()
+                    for x in filesToAdd.itervalues())
+            if (maxSize and changeSetTroves
+                    and changeSetSize + troveSize > maxSize):
+                self._commit(changeSet)
+                changeSet = ChangeSet()
+                changeSetSize = changeSetTroves = 0
+            changeSetSize += troveSize
+            changeSetTroves += 1
+
             # Add files and contents to changeset.
             for fileId, (fileObj, fileContents, cfgFile) in filesToAdd.items():
                 changeSet.addFileContents(fileObj.pathId(), fileObj.fileId(),
@@ -323,28 +689,12 @@ class ShadowBatch(object):
             newTrove.computeDigests()
             newTroveCs = newTrove.diff(None, absolute=True)[0]
             changeSet.newTrove(newTroveCs)
-            doCommit = True
 
             package.setDownstreamVersion(newTrove.getVersion())
             log.debug('Created %s=%s', newTrove.getName(), newTrove.getVersion())
 
-        if doCommit:
-            cook.signAbsoluteChangesetByConfig(changeSet, self.helper.cfg)
-            f = tempfile.NamedTemporaryFile(dir=os.getcwd(), suffix='.ccs',
-                    delete=False)
-            f.close()
-            changeSet.writeToFile(f.name)
-            try:
-                self.helper.getRepos().commitChangeSet(changeSet)
-            except:
-                log.error("Error committing changeset to repository, "
-                        "failed changeset is saved at %s", f.name)
-                raise
-            else:
-                os.unlink(f.name)
-
-        for path in deleteDirs:
-            shutil.rmtree(path)
+        if changeSetTroves:
+            self._commit(changeSet)
 
 
 def _createVersion(package, helper, version):
@@ -359,28 +709,29 @@ def _createVersion(package, helper, version):
     return newVersion
 
 
-def _sourcesIdentical(oldTrove, newTrove, changeSets):
+def _sourcesIdentical(oldTrove, newTrove, oldChangeSet, oldSHA1s,
+        filesToAdd):
     '''
     Return C{True} if C{oldTrove} and C{newTrove} have the same
-    contents.
+    contents. The old files are read from C{oldChangeSet}, and the
+    content SHA-1 of each one is remembered in C{oldSHA1s} so it is only
+    thawed once per batch. C{filesToAdd} holds the new files not in the
+    old changeset.
     '''
     def getSHA1(fileId):
-        for changeSet in changeSets:
-            if isinstance(changeSet, ChangeSet):
-                fileChange = changeSet.getFileChange(None, fileId)
-                if not fileChange:
-                    continue
-
-                fileObj = ThawFile(fileChange, None)
-                return fileObj.contents.sha1()
-            else:
-                fileObj = changeSet.get(fileId, None)
-                if not fileObj:
-                    continue
-
-                return fileObj[0].contents.sha1()
-
-        raise KeyError("file is not in any changeset")
+        if fileId in filesToAdd:
+            fileObj = filesToAdd[fileId][0]
+        elif fileId in oldSHA1s:
+            return oldSHA1s[fileId]
+        else:
+            fileObj = ThawFile(oldChangeSet.getFileChange(None, fileId), None)
+        if fileObj.hasContents:
+            sha1 = fileObj.contents.sha1()
+        else:
+            sha1 = None
+        if fileId not in filesToAdd:
+            oldSHA1s[fileId] = sha1
+        return sha1
 
     if oldTrove.getFactory() != newTrove.getFactory():
         return False
@@ -394,23 +745,28 @@ def _sourcesIdentical(oldTrove, newTrove, changeSets):
         newPathId, _, newFileId, _ = newPaths[path]
         if oldFileId == newFileId:
             continue
-        if getSHA1(oldFileId) != getSHA1(newFileId):
+        # Files without contents only match if their fileIds do
+        oldSHA1 = getSHA1(oldFileId)
+        if oldSHA1 is None or oldSHA1 != getSHA1(newFileId):
             return False
     return True
 
 
-def _makeSourceTrove(package, helper):
-    cs = ChangeSet()
-    filesToAdd = {}
+def _makeSourceTrove(package, helper, existingVersions=None):
+    '''
+    Build an in-memory source trove for I{package} holding its recipe
+    files, for use when loading a factory recipe.
+    '''
     ver = macro.expand(package.getBaseVersion(), package)
     version = _createVersion(package, helper, ver)
-    latestSpec = (package.getName(), str(version.trailingLabel()), None)
-    results = helper.getRepos().findTroves(None,[latestSpec],allowMissing=True,
-                        getLeaves=False,troveTypes=trovesource.TROVE_QUERY_ALL)
-    if results:
+    if existingVersions is None:
+        latestSpec = (package.getName(), str(version.trailingLabel()), None)
+        results = helper.getRepos().findTroves(None, [latestSpec],
+                allowMissing=True, getLeaves=False,
+                troveTypes=trovesource.TROVE_QUERY_ALL)
         existingVersions = [x[1] for x in results.get(latestSpec, ())]
-        while version in existingVersions:
-            version.incrementSourceCount()
+    while version in existingVersions:
+        version.incrementSourceCount()
 
     new = Trove(package.name, version, deps.Flavor())
     new.setFactory(package.targetConfig.factory)
@@ -425,60 +781,42 @@ def _makeSourceTrove(package, helper):
                     config=isText)
         fileStream = fileHelper.get(pathId)
         fileStream.flags.isSource(set=True)
-        fileId = fileStream.fileId()
-        fileVersion = new.getVersion()
-        key = pathId + fileId
-        filesToAdd[key] = (fileStream, fileHelper.contents, isText)
-        new.addFile(pathId, path, fileVersion, fileId)
+        new.addFile(pathId, path, new.getVersion(), fileStream.fileId())
     new.invalidateDigests()
     new.computeDigests()
-    for key, (fileObj, fileContents, cfgFile) in filesToAdd.items():
-        cs.addFileContents(fileObj.pathId(), fileObj.fileId(),
-                    ChangedFileTypes.file, fileContents, cfgFile)
-        cs.addFile(None, fileObj.fileId(), fileObj.freeze())
-    cs.newTrove(new.diff(None, absolute=True)[0])
-    return new.getNameVersionFlavor(), cs
-
-
-def tempSourceTrove(recipePath, package, helper):
-    from conary import state
-    from conary import checkin
-    from conary import trove
-    from conary.lib import util as cnyutil
-    pkgname = package.name.split(':')[0]
-    nvf, cs = _makeSourceTrove(package, helper)
-    targetDir = os.path.join(os.path.dirname(recipePath), pkgname)
-    cnyutil.mkdirChain(targetDir)
-    sourceStateMap = {}
-    pathMap = {}
-    conaryStateTargets = {}
-    troveCs = cs.getNewTroveVersion(*nvf)
-    trv = trove.Trove(troveCs)
-    sourceState = state.SourceState(nvf[0], nvf[1], nvf[1].branch())
-    if trv.getFactory():
-        sourceState.setFactory(trv.getFactory())
-    conaryState = state.ConaryState(helper.cfg.context, sourceState)
-    sourceStateMap[trv.getNameVersionFlavor()] = sourceState
-    conaryStateTargets[targetDir] = conaryState
-    for (pathId, path, fileId, version) in troveCs.getNewFileList():
-        pathMap[(nvf, path)] = (targetDir, pathId, fileId, version)
-    # Explode changeset contents.
-    checkin.CheckoutExploder(cs, pathMap, sourceStateMap)
-    # Write out CONARY state files.
-    for targetDir, conaryState in conaryStateTargets.iteritems():
-            conaryState.write(targetDir + '/CONARY')
-    return trv, targetDir
-
-def _loadRecipe(helper, package, recipePath):
+    return new
+
+
+def _flattenLoadedSpecs(loadedSpecs):
+    out = []
+    for spec, (troveTup, children) in sorted(loadedSpecs.iteritems()):
+        out.append((str(spec), troveTup[0], troveTup[1].freeze()))
+        out.extend(_flattenLoadedSpecs(children))
+    return out
+
+
+def _loadRecipe(helper, package, recipePath, loadedSpecs=None,
+        existingVersions=None):
+    '''
+    Load and instantiate the recipe for I{package}. If C{loadedSpecs} is
+    given, the superclasses loaded for the recipe are appended to it as
+    C{(troveSpec, name, frozenVersion)} tuples. C{existingVersions}, if
+    known, lists the versions of the package already on the target label.
+    '''
     # Load the recipe
     use.setBuildFlagsFromFlavor(package.getPackageName(),
             helper.cfg.buildFlavor, error=False)
     if package.targetConfig.factory and package.targetConfig.factory != 'factory':
-        sourceTrove, targetDir = tempSourceTrove(recipePath, package, helper)
-        loader = RecipeLoaderFromSourceDirectory(sourceTrove, repos=helper.getRepos(),
-                            cfg=helper.cfg, parentDir=targetDir,
-                            labelPath=helper.plan.installLabelPath
-                            )
+        sourceTrove = _makeSourceTrove(package, helper, existingVersions)
+        # Feed the loader straight from the recipe files in memory.
+        getFile = lambda repos, fileId, fileVersion, path: \
+                package.openFile(path)
+        loader = RecipeLoaderFromSourceTrove(sourceTrove,
+                repos=helper.getRepos(), cfg=helper.cfg,
+                parentDir=os.path.dirname(recipePath),
+                labelPath=helper.plan.installLabelPath,
+                getFileFunction=getFile,
+                )
     else:
         sourceTrove = None
         loader = RecipeLoader(recipePath, helper.cfg, helper.getRepos(),
@@ -487,6 +825,8 @@ def _loadRecipe(helper, package, recipePath):
                         )
 
     recipeClass = loader.getRecipe()
+    if loadedSpecs is not None:
+        loadedSpecs.extend(_flattenLoadedSpecs(loader.getLoadedSpecs()))
     dummybranch = Branch([helper.plan.getTargetLabel()])
     dummyrev = Revision('1-1')
     dummyver = dummybranch.createVersion(dummyrev)
@@ -495,7 +835,7 @@ def _loadRecipe(helper, package, recipePath):
             'buildbranch': dummybranch.asString(),
             }
     # Instantiate and setup if needed
-    lcache = RepositoryCache(helper.getRepos(),
+    lcache = RepositoryCache(_ThreadRepos(helper),
             refreshFilter=lambda x: helper.plan.refreshSources)
     if recipeClass.getType() == cny_recipe.RECIPE_TYPE_GROUP:
         recipeObj = recipeClass(
@@ -530,16 +870,248 @@ def _loadRecipe(helper, package, recipePath):
     return recipeObj
 
 
-def _getSnapshot(helper, package, source, tempDir):
+class _ThreadRepos(object):
+    """
+    Repository client for a recipe's lookaside cache, which may be used
+    by L{SnapshotFetcher} threads. Conary clients aren't thread-safe, so
+    each thread other than the one that loaded the recipe is given a
+    client of its own.
+    """
+
+    def __init__(self, helper):
+        self._helper = helper
+        self._owner = threading.current_thread()
+
+    def _getRepos(self):
+        if threading.current_thread() is self._owner:
+            return self._helper.getRepos()
+        if not hasattr(_threadHelpers, 'helper'):
+            _threadHelpers.helper = ClientHelper(self._helper.cfg,
+                    self._helper.plan, self._helper.pluginMgr)
+        return _threadHelpers.helper.getRepos()
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self._getRepos(), name)
+
+
+# Per-thread client helper used by _ThreadRepos
+_threadHelpers = threading.local()
+
+
+# State shared with recipe loader worker processes. It is set before the
+# pool is created so that the workers inherit it when they are forked.
+_loaderState = None
+
+
+def _initLoaderWorker():
+    resetStopHandlers()
+    helper = _loaderState[0]
+    # Don't share the parent's repository connections.
+    helper.configChanged()
+
+
+def _loadRecipeWorker(idx):
+    helper, packages, recipePaths, existingVersions = _loaderState
+    package = packages[idx]
+    try:
+        loadedSpecs = []
+        recipeObj = _loadRecipe(helper, package, recipePaths[idx], loadedSpecs,
+                existingVersions[idx])
+        return RecipeInfo.fromRecipe(recipeObj, loadedSpecs), None
+    except:
+        log.exception("Error loading recipe for %s:", package.name)
+        e_type, e_value = sys.exc_info()[:2]
+        return None, '%s: %s' % (e_type.__name__, e_value)
+
+
+def _loadRecipesParallel(helper, packages, recipePaths, existingVersions,
+        workers, whileWaiting=None):
+    '''
+    Load each package's recipe in a pool of worker processes and return
+    a list of L{RecipeInfo} objects in package order. If given,
+    C{whileWaiting} is called once the workers have started.
+    '''
+    global _loaderState
+    _loaderState = helper, packages, recipePaths, existingVersions
+    pool = multiprocessing.Pool(processes=min(workers, len(packages)),
+            initializer=_initLoaderWorker)
+    try:
+        pending = pool.map_async(_loadRecipeWorker, range(len(packages)),
+                chunksize=1)
+        if whileWaiting:
+            whileWaiting()
+        results = pending.get()
+    except:
+        pool.terminate()
+        pool.join()
+        raise
+    finally:
+        _loaderState = None
+    pool.close()
+    pool.join()
+
+    infos = []
+    for package, (info, error) in zip(packages, results):
+        if info is None:
+            raise RuntimeError("Failed to load recipe for %s: %s"
+                    % (package.name, error))
+        infos.append(info)
+    return infos
+
+
+def _snapshotHost(source):
+    """
+    Return the host a source will be fetched from, for the purpose of
+    limiting concurrent fetches.
+    """
+    url = getattr(source, 'url', None) or source.getPath()
+    return urlparse.urlsplit(url)[1]
+
+
+class SnapshotFetcher(object):
+    """
+    Call L{_getSnapshot} on a pool of threads. Up to C{snapshotWorkers}
+    snapshots are fetched at once, and no more than
+    C{snapshotWorkersPerHost} of those from the same host. Fetches from a
+    host that is already busy wait in a queue for that host, so they
+    never tie up a pool thread. Whichever thread runs a fetch uses its
+    own repository client (see L{_ThreadRepos}).
+    """
+
+    def __init__(self, helper, cache=None):
+        self.helper = helper
+        self.cache = cache
+        self.pool = None
+        self.lock = threading.Lock()
+        self.hostQueues = {}
+        self.hostActive = {}
+
+    def submit(self, package, source, tempDir):
+        """
+        Start fetching a snapshot of C{source}. Returns an object whose
+        C{get} method waits for and returns the snapshot path.
+        """
+        if self.pool is None:
+            self.pool = ThreadPool(max(self.helper.plan.snapshotWorkers, 1))
+        host = _snapshotHost(source)
+        result = _SnapshotResult()
+        task = (host, package, source, tempDir, result)
+        with self.lock:
+            active = self.hostActive.get(host, 0)
+            if active >= max(self.helper.plan.snapshotWorkersPerHost, 1):
+                self.hostQueues.setdefault(host, deque()).append(task)
+                return result
+            self.hostActive[host] = active + 1
+        self.pool.apply_async(self._fetch, task)
+        return result
+
+    def _fetch(self, host, package, source, tempDir, result):
+        try:
+            result.set(_getSnapshot(self.helper, package, source, tempDir,
+                    self.cache))
+        except:
+            log.exception("Error fetching %s for %s:", source.getPath(),
+                    package.name)
+            result.setError(sys.exc_info())
+
+        # Start the next fetch from this host, if any are waiting.
+        with self.lock:
+            queue = self.hostQueues.get(host)
+            if not queue:
+                self.hostActive[host] -= 1
+                return
+            task = queue.popleft()
+        self.pool.apply_async(self._fetch, task)
+
+    def close(self):
+        """
+        Stop the worker threads, abandoning any fetches that are still
+        queued.
+        """
+        if self.pool is None:
+            return
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+
+
+class _SnapshotResult(object):
+    """
+    The eventual result of a snapshot fetch by L{SnapshotFetcher}.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.excInfo = None
+
+    def set(self, value):
+        self.value = value
+        self.event.set()
+
+    def setError(self, excInfo):
+        self.excInfo = excInfo
+        self.event.set()
+
+    def get(self):
+        """
+        Wait for the fetch to finish and return the snapshot path, or
+        raise the error the fetch failed with.
+        """
+        # Waiting with a timeout keeps the main thread interruptible
+        while not self.event.wait(1):
+            pass
+        if self.excInfo:
+            raise self.excInfo[0], self.excInfo[1], self.excInfo[2]
+        return self.value
+
+
+_pathLocks = {}
+_pathLocksLock = threading.Lock()
+
+
+def _getPathLock(path):
+    """
+    Return a lock serializing fetches of C{path}, which may be shared by
+    several sources: a lookaside file or the SCM cache of a repository.
+    """
+    with _pathLocksLock:
+        return _pathLocks.setdefault(path, threading.Lock())
+
+
+_re_commitId = re.compile('^[0-9a-f]{12,40}$')
+
+
+def _snapshotCacheKey(cache, source, fullPath):
+    """
+    Return the snapshot cache key for C{source}, or C{None} if it does not
+    name an exact revision and so can't be cached.
+    """
+    revision = getattr(source, 'tag', None)
+    if not revision or not _re_commitId.match(revision):
+        return None
+    return cache.makeKey(getattr(source, 'url', ''), revision,
+            os.path.basename(fullPath))
+
+
+def _getSnapshot(helper, package, source, tempDir, cache=None):
     """
     Create a snapshot of a revision-control source in a temporary location.
+    Snapshots of exact revisions are reused from C{cache}, if given.
 
     Returns a tuple C{(path, delete)} where C{delete} is C{None} or a directory
     that should be deleted after use.
     """
     if not hasattr(source, 'createSnapshot'):
-        fullPath = source.fetch(
-                refreshFilter=lambda x: helper.plan.refreshSources)
+        # Sources of one package share its recipe's lookaside cache, so
+        # they are fetched one at a time even when their hosts differ.
+        cacheDir = os.path.join(helper.cfg.lookaside, source.recipe.name)
+        with _getPathLock(cacheDir):
+            with _getPathLock(source.getPath()):
+                fullPath = source.fetch(
+                        refreshFilter=lambda x: helper.plan.refreshSources)
         if not source.ephemeral:
             return fullPath
         name = os.path.basename(fullPath)
@@ -549,6 +1121,12 @@ def _getSnapshot(helper, package, source, tempDir):
 
     fullPath = source.getFilename()
     snapPath = os.path.join(tempDir, os.path.basename(fullPath))
+    cacheKey = cache and _snapshotCacheKey(cache, source, fullPath)
+    if (cacheKey and not helper.plan.refreshSources
+            and cache.get(cacheKey, snapPath)):
+        log.debug("Using cached snapshot for %s", fullPath)
+        return snapPath
+
     scm = package.getSCM()
     fetched = False
     if scm:
@@ -561,14 +1139,17 @@ def _getSnapshot(helper, package, source, tempDir):
         reposPath = '/'.join(fullPath.split('/')[:-1] + [ source.name ])
         repositoryDir = source.recipe.laReposCache.getCachePath(
                 source.recipe.name, reposPath)
-        if not os.path.exists(repositoryDir):
-            mkdirChain(os.path.dirname(repositoryDir))
-            source.createArchive(repositoryDir)
-        else:
-            source.updateArchive(repositoryDir)
-        source.createSnapshot(repositoryDir, snapPath)
+        with _getPathLock(repositoryDir):
+            if not os.path.exists(repositoryDir):
+                mkdirChain(os.path.dirname(repositoryDir))
+                source.createArchive(repositoryDir)
+            else:
+                source.updateArchive(repositoryDir)
+            source.createSnapshot(repositoryDir, snapPath)
 
     if fullPath.endswith('.bz2') and not checkBZ2(snapPath):
         raise RuntimeError("Autosource file %r is corrupt!" % (snapPath,))
 
+    if cacheKey:
+        cache.put(cacheKey, snapPath)
     return snapPath
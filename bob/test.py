@@ -20,11 +20,18 @@ Module containing test-processing code.
 '''
 
 import logging
+import multiprocessing
+import os
 import re
-import xml.dom.minidom
+import shutil
+import tempfile
+from array import array
+from collections import deque
+from xml.parsers import expat
+from xml.sax.saxutils import quoteattr
 
 from bob import coverage
-from bob.util import HashableDict
+from bob.util import HashableDict, resetStopHandlers
 
 log = logging.getLogger('bob.test')
 
@@ -34,6 +41,9 @@ re_config_output = re.compile('^/usr/share/testinfo/[^/]+/configuration.txt$')
 re_test_output = re.compile('^/usr/share/testinfo/[^/]+/tests/.*$')
 re_cover_output = re.compile('^/usr/share/testinfo/[^/]+/coverage/.*$')
 
+# Characters not allowed in the names of split JUnit files
+re_unsafe_path = re.compile('[^A-Za-z0-9_.-]')
+
 
 # Possible test statuses, in order of increasing severity
 TEST_NONE   = -1
@@ -51,59 +61,144 @@ STATUS_NAMES = {TEST_NONE:  'unknown',
 class TestParseError(Exception): pass
 
 
+class Configuration(HashableDict):
+    '''
+    A test configuration. Use L{internConfiguration} to get one, so that
+    each distinct configuration is stored once and hashed once.
+    '''
+    __slots__ = ['_hash']
+
+    def __init__(self, *args, **kwargs):
+        HashableDict.__init__(self, *args, **kwargs)
+        self._hash = HashableDict.__hash__(self)
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        # Re-intern when unpickled.
+        return internConfiguration, (dict(self),)
+
+
+_configurations = {}
+
+
+def internConfiguration(configuration):
+    '''
+    Return the shared L{Configuration} equal to the mapping
+    C{configuration}.
+    '''
+    if isinstance(configuration, Configuration):
+        return configuration
+    key = tuple(sorted(configuration.items()))
+    interned = _configurations.get(key)
+    if interned is None:
+        interned = _configurations[key] = Configuration(configuration)
+    return interned
+
+
 class TestCase(object):
+    '''
+    Results of one test across all the configurations it was run in.
+    Statuses and durations are stored in arrays parallel to the list of
+    configurations, and messages are only kept for failed runs.
+    '''
+    __slots__ = ['name', 'status', 'configurations', 'statuses',
+        'durations', 'messages']
+
     def __init__(self, name):
         self.name = name
         self.status = TEST_NONE
-        self.runs = {}
+        self.configurations = []
+        self.statuses = array('b')
+        self.durations = array('d')
+        self.messages = {}
+
+    def __getstate__(self):
+        return dict((x, getattr(self, x)) for x in self.__slots__)
+
+    def __setstate__(self, state):
+        for key, value in state.iteritems():
+            setattr(self, key, value)
+
+    @property
+    def runs(self):
+        '''
+        Map of configuration to a dict of the status, duration and
+        message of the run in that configuration.
+        '''
+        return dict((cfg, self._get_run(i))
+            for (i, cfg) in enumerate(self.configurations))
+
+    def _get_run(self, i):
+        return dict(status=self.statuses[i], duration=self.durations[i],
+            message=self.messages.get(i, u''))
+
+    def _set_run(self, configuration, status, duration, message):
+        try:
+            i = self.configurations.index(configuration)
+        except ValueError:
+            i = len(self.configurations)
+            self.configurations.append(configuration)
+            self.statuses.append(status)
+            self.durations.append(duration)
+        else:
+            self.statuses[i] = status
+            self.durations[i] = duration
+        if status > TEST_OK:
+            self.messages[i] = message
+        else:
+            self.messages.pop(i, None)
+        self.status = max(self.status, status)
 
     def add_run(self, status, duration, configuration, message):
         '''Add a run to the test case.'''
-        run = dict(status=status, duration=duration, message=message)
-        if configuration in self.runs:
+        configuration = internConfiguration(configuration)
+        if configuration in self.configurations:
             # Fudge the configuration to ensure a unique result
             log.warning('Test %s duplicated in configuration %r',
                 self.name, configuration)
             i = 0
-            while configuration in self.runs:
+            while configuration in self.configurations:
                 i += 1
-                configuration = HashableDict(configuration)
+                configuration = dict(configuration)
                 configuration['__fudge'] = str(i)
-        self.runs[configuration] = run
-        self.status = max(self.status, status)
+                configuration = internConfiguration(configuration)
+        self._set_run(configuration, status, duration, message)
 
     def merge(self, other):
         '''
         Merge an existing TestCase into this one.
         '''
 
-        for configuration, run in other.runs:
-            if configuration in self.runs:
+        for i, configuration in enumerate(other.configurations):
+            if configuration in self.configurations:
                 log.warning('Test %s already has an entry for conf %r; '
                     'overwriting (while merging)', self.name, configuration)
-            self.runs[configuration] = run
-            self.status = max(self.status, run['status'])
+            self._set_run(configuration, other.statuses[i],
+                other.durations[i], other.messages.get(i, u''))
 
     def get_failing_runs(self):
         '''Return failing runs from this test case.'''
-        return dict((cfg, run) for (cfg, run) in self.runs.iteritems() \
-            if run['status'] > TEST_OK)
+        return dict((cfg, self._get_run(i))
+            for (i, cfg) in enumerate(self.configurations)
+            if self.statuses[i] > TEST_OK)
 
     def max_runtime(self):
         '''Return the maximum test duration across all runs.'''
-        return max(x['duration'] for x in self.runs.values())
+        return max(self.durations)
 
     def failing_configurations(self):
         '''Find common factors in failed runs.'''
 
         # Check the obvious case - all runs failed
-        if len(self.runs) == len(self.get_failing_runs()):
+        if min(self.statuses) > TEST_OK:
             return 'Failed in all configurations'
 
         # For each factor, accumulate passing and failing values
         factors = {}
-        for configuration, run in self.runs.iteritems():
-            passed = run['status'] <= TEST_OK
+        for i, configuration in enumerate(self.configurations):
+            passed = self.statuses[i] <= TEST_OK
             for key, value in configuration.iteritems():
                 factor = factors.setdefault(key, (set(), set()))
                 if passed:
@@ -134,48 +229,235 @@ class TestCase(object):
         formatter and produce a single report summarizing all failures in a
         particular test case.
         '''
+        parts = []
+        self.write_exception_report(parts.append)
+        return u''.join(parts)
+
+    def write_exception_report(self, write):
+        '''
+        Write the report produced by L{exception_report} piece by piece
+        by calling C{write}.
+        '''
 
         failed = self.get_failing_runs()
-        last_lines = failed.values()[0]['message'].splitlines()
+        last_lines = failed.values()[0]['message'].splitlines()[-3:]
 
         # De-indent the leading traceback chunk by 2 spaces
-        if last_lines[-3].startswith('  ') \
-          and last_lines[-2].startswith('  '):
-            last_lines[-3] = last_lines[-3][2:]
-            last_lines[-2] = last_lines[-2][2:]
+        if len(last_lines) == 3 and last_lines[0].startswith('  ') \
+          and last_lines[1].startswith('  '):
+            last_lines[0] = last_lines[0][2:]
+            last_lines[1] = last_lines[1][2:]
 
-        output = '\n'.join(last_lines[-3:]) + '\n'
-        output += self.failing_configurations() + '\n'
+        write('\n'.join(last_lines) + '\n')
+        write(self.failing_configurations() + '\n')
 
         for configuration, run in failed.iteritems():
-            output += '\n'
-            output += '+++ ' + ', '.join('%s=%s' % (key, value) \
-                for (key, value) in configuration.iteritems()) + '\n'
-            output += run['message']
-
-        return output
+            write('\n')
+            write('+++ ' + ', '.join('%s=%s' % (key, value) \
+                for (key, value) in configuration.iteritems()) + '\n')
+            write(run['message'])
 
     def write_junit(self, fileobj):
         '''Write an individual test in JUnit-style XML format.'''
 
+        write = _writer(fileobj)
         classname, name = self.name.rsplit('.', 1)
         duration = self.max_runtime()
+        attrs = 'classname=%s name=%s time="%0.03f"' % (
+            quoteattr(classname), quoteattr(name), duration)
 
         if self.status == TEST_OK:
-            print >>fileobj, \
-                '<testcase classname="%s" name="%s" time="%0.03f" />' \
-                % (classname, name, duration)
+            write('<testcase %s />\n' % attrs)
         elif self.status in (TEST_FAIL, TEST_ERROR):
-            tag_names = {TEST_FAIL: 'failure', TEST_ERROR: 'error'}
-            message = self.exception_report()
-            print >>fileobj, \
-                '<testcase classname="%s" name="%s" time="%0.03f">' \
-                % (classname, name, duration)
-            print >>fileobj, \
-                '<%s type="Exception" message="">' % tag_names[self.status]
-            print >>fileobj, '<![CDATA[' + message + ']]>'
-            print >>fileobj, '</%s>' % tag_names[self.status]
-            print >>fileobj, '</testcase>'
+            tag_name = {TEST_FAIL: 'failure', TEST_ERROR: 'error'}[
+                self.status]
+            write('<testcase %s>\n' % attrs)
+            write('<%s type="Exception" message="">\n' % tag_name)
+            write('<![CDATA[')
+            # A CDATA section can't contain its own terminator, so split
+            # the section wherever one occurs.
+            self.write_exception_report(lambda x:
+                write(x.replace(']]>', ']]]]><![CDATA[>')))
+            write(']]>\n')
+            write('</%s>\n' % tag_name)
+            write('</testcase>\n')
+
+
+def _writer(fileobj):
+    '''
+    Return a function that writes strings to C{fileobj}, encoding
+    unicode as UTF-8.
+    '''
+    def write(data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        fileobj.write(data)
+    return write
+
+
+class JUnitParser(object):
+    '''
+    Incremental parser for JUnit-style XML. Each test case is passed to
+    C{callback} as a C{(name, status, duration, message)} tuple as soon
+    as it has been parsed, and only the test case currently being parsed
+    is held in memory.
+
+    A test case is reported once for each test suite enclosing it. Its
+    message is the non-blank text, CDATA and comments inside it, taken
+    breadth-first.
+    '''
+
+    def __init__(self, callback, maxMessageSize=0):
+        self.callback = callback
+        self.maxMessageSize = maxMessageSize
+        # Open test suites, as [name, sawTestcase, camelCaseResults]
+        self.suites = []
+        # The test case being parsed, and a stack of the child lists of
+        # its open elements. Each child is a (kind, value) tuple where
+        # kind is 'e' for an element or 'd' for a list of data segments.
+        self.case = None
+        self.stack = []
+        self.size = 0
+        self.inCdata = False
+
+    def parse(self, fileobj):
+        '''
+        Parse all of C{fileobj}, raising L{TestParseError} if it is not
+        well-formed.
+        '''
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = self._startElement
+        parser.EndElementHandler = self._endElement
+        parser.CharacterDataHandler = self._characterData
+        parser.StartCdataSectionHandler = self._startCdata
+        parser.EndCdataSectionHandler = self._endCdata
+        parser.CommentHandler = self._addData
+        parser.ProcessingInstructionHandler = \
+            lambda target, data: self._addData(data)
+        try:
+            parser.ParseFile(fileobj)
+        except expat.ExpatError, e:
+            raise TestParseError(str(e))
+
+    def _startElement(self, name, attrs):
+        if name == 'testsuite':
+            self.suites.append([attrs.get('name') or 'DefaultTestSuite',
+                False, []])
+        if self.case is not None:
+            children = []
+            self.stack[-1].append(('e', children))
+            self.stack.append(children)
+            if name == 'error':
+                self.case['error'] = True
+            elif name == 'failure':
+                self.case['failure'] = True
+        elif name in ('testcase', 'testCase') and self.suites:
+            self.case = dict(tag=name, attrs=attrs, error=False,
+                failure=False, truncated=False)
+            self.stack = [[]]
+            self.size = 0
+
+    def _endElement(self, name):
+        if self.case is not None:
+            if len(self.stack) > 1:
+                self.stack.pop()
+            else:
+                self._finishCase()
+        elif name == 'testsuite':
+            _, sawTestcase, camelResults = self.suites.pop()
+            # camelCase testCase elements only count in suites that have
+            # no plain testcase elements.
+            if not sawTestcase:
+                for result in camelResults:
+                    self.callback(result)
+
+    def _startCdata(self):
+        self.inCdata = True
+        if self.stack:
+            # Each CDATA section is a separate segment.
+            self.stack[-1].append(('d', []))
+
+    def _endCdata(self):
+        self.inCdata = False
+        if self.stack:
+            # Text after a CDATA section starts a new segment, too.
+            self.stack[-1].append(('d', []))
+
+    def _characterData(self, data):
+        if not self.stack:
+            return
+        children = self.stack[-1]
+        if children and children[-1][0] == 'd':
+            self._store(children[-1][1], data)
+        else:
+            segment = []
+            children.append(('d', segment))
+            self._store(segment, data)
+
+    def _addData(self, data):
+        if not self.stack:
+            return
+        segment = []
+        self.stack[-1].append(('d', segment))
+        self._store(segment, data)
+        # Following text is another segment.
+        self.stack[-1].append(('d', []))
+
+    def _store(self, segment, data):
+        if self.maxMessageSize:
+            if self.size >= self.maxMessageSize:
+                self.case['truncated'] = True
+                return
+            self.size += len(data)
+        segment.append(data)
+
+    def _finishCase(self):
+        case, children = self.case, self.stack[0]
+        self.case = None
+        self.stack = []
+
+        attrs = case['attrs']
+        try:
+            classname = attrs.get('classname', attrs.get('className'))
+            testname = attrs['name']
+            duration = float(attrs['time'])
+        except (KeyError, ValueError), e:
+            raise TestParseError("Invalid %s element: %s" % (case['tag'], e))
+        if classname is None:
+            raise TestParseError("Invalid %s element: no class name"
+                % case['tag'])
+
+        # Collect data from all descendants, breadth-first.
+        out = []
+        queue = deque(children)
+        while queue:
+            kind, value = queue.popleft()
+            if kind == 'e':
+                queue.extend(value)
+                continue
+            data = u''.join(value)
+            if data.strip() != '':
+                out.append(data)
+        message = u''.join(out)
+        if case['truncated'] or (self.maxMessageSize
+                and len(message) > self.maxMessageSize):
+            message = message[:self.maxMessageSize] + u'\n[truncated]\n'
+
+        if case['error']:
+            status = TEST_ERROR
+        elif case['failure']:
+            status = TEST_FAIL
+        else:
+            status = TEST_OK
+
+        for suite in self.suites:
+            name = ".".join([suite[0], classname, testname])
+            result = (name, status, duration, message)
+            if case['tag'] == 'testcase':
+                suite[1] = True
+                self.callback(result)
+            else:
+                suite[2].append(result)
 
 
 class TestSuite(object):
@@ -205,74 +487,58 @@ class TestSuite(object):
             else:
                 self.tests[name] = case
             self.status = max(self.status, case.status)
+        self.status = max(self.status, other.status)
 
-    def load_junit(self, fileobj, configuration):
+    def load_junit(self, fileobj, configuration, maxMessageSize=0):
         '''
-        Load test data from a JUnit-style XML file.
+        Load test data from a JUnit-style XML file. Test messages longer
+        than C{maxMessageSize} characters are truncated, if it is set.
         '''
 
-        try:
-            document = xml.dom.minidom.parse(fileobj)
-        except Exception, e:
-            raise TestParseError(str(e))
-        
-        # get all the testsuite nodes
-        testSuiteNodes = document.getElementsByTagName('testsuite')
-        
-        # process each test suite node
-        for node in testSuiteNodes:            
-            self.process_testsuite(node, configuration)            
-            
-    def process_testsuite(self, tsNode, configuration):
-        """
-        Process a single testsuite node extracting the data we care about
-        """
-        
-        # see if the testsuite has a name
-        attrs = tsNode.attributes
-        testSuite = (attrs and attrs.has_key('name')) and attrs['name'].value \
-            or "DefaultTestSuite"
-        
-        # get all the test case nodes, which may or may not be camelCase
-        testCaseNodes = tsNode.getElementsByTagName('testcase')
-        if not testCaseNodes:
-            testCaseNodes = tsNode.getElementsByTagName('testCase')
-            
-        for node in testCaseNodes:
-            attrs = node.attributes
-            
-            # get the class name (may be camel case)
-            if attrs.has_key('classname'):
-                classname='classname'
-            else:
-                classname='className'
-                
-            name = ".".join([testSuite, attrs[classname].value, 
-                            attrs['name'].value])
-            
-            # get the duration
-            duration = float(attrs['time'].value)
-
-            # Get the actual result status
-            message = grabXMLData(node)
-            if node.getElementsByTagName('error'):
-                status = TEST_ERROR
-            elif node.getElementsByTagName('failure'):
-                status = TEST_FAIL
-            else:
-                status = TEST_OK
-
+        # Nothing is added unless the whole file parses.
+        results = []
+        JUnitParser(results.append, maxMessageSize).parse(fileobj)
+        for name, status, duration, message in results:
             self.add_test(name, status, duration, configuration, message)
 
-    def write_junit(self, fileobj):
+    def write_junit(self, fileobj, names=None):
         '''
         Write test data in JUnit-style XML format.
+
+        @param names: If given, write only the tests with these names.
         '''
 
-        print >>fileobj, '<testsuite>'
-        for name in sorted(self.tests.keys()):
+        if names is None:
+            names = self.tests.keys()
+        fileobj.write('<testsuite>\n')
+        for name in sorted(names):
             self.tests[name].write_junit(fileobj)
-        print >>fileobj, '</testsuite>'
+        fileobj.write('</testsuite>\n')
+
+    def write_junit_split(self, directory, prefix='junit-'):
+        '''
+        Write test data as one JUnit-style XML file per package (the test
+        class name without the class) in C{directory}, named after the
+        package with C{prefix} prepended. Packages whose names only differ
+        in characters that are unsafe in a file name get a numeric suffix.
+        '''
+
+        packages = {}
+        for name in self.tests:
+            classname = name.rsplit('.', 1)[0]
+            package = classname.rsplit('.', 1)[0]
+            packages.setdefault(package, []).append(name)
+        used = set()
+        for package, names in sorted(packages.iteritems()):
+            base = prefix + re_unsafe_path.sub('_', package)
+            fileName = base + '.xml'
+            counter = 1
+            while fileName in used:
+                counter += 1
+                fileName = '%s-%d.xml' % (base, counter)
+            used.add(fileName)
+            with open(os.path.join(directory, fileName), 'w') as fobj:
+                self.write_junit(fobj, names)
 
     def isSuccessful(self):
         return self.status <= TEST_OK
@@ -288,69 +554,186 @@ class TestSuite(object):
         '''
         Return a short string describing the state of the testsuite.
         '''
+        return _describe(self.status,
+            [test.status for test in self.tests.itervalues()])
+
+
+class TestSummary(object):
+    '''
+    The overall status of each test merged from a series of
+    L{TestSuite}s, which is enough to describe the results of a run
+    without keeping every test run in memory.
+    '''
+
+    def __init__(self):
+        self.statuses = {}
+        self.status = TEST_NONE
+
+    def merge(self, test_suite):
+        '''
+        Merge the test statuses from a L{TestSuite} into this summary.
+        '''
+        for name, case in test_suite.tests.iteritems():
+            self.statuses[name] = max(self.statuses.get(name, TEST_NONE),
+                case.status)
+        self.status = max(self.status, test_suite.status)
+
+    def isSuccessful(self):
+        return self.status <= TEST_OK
+
+    def describe(self):
+        '''
+        Return a short string describing the state of the merged tests.
+        '''
+        return _describe(self.status, self.statuses.itervalues())
+
+
+def _describe(overall_status, test_statuses):
+    '''
+    Describe a set of tests from their overall status and the status of
+    each test.
+    '''
 
-        if not self.tests and self.status == TEST_NONE:
-            return 'Status: No tests found'
+    per_status = {}
+    for status in test_statuses:
+        per_status[status] = per_status.get(status, 0) + 1
 
-        per_status = {}
-        for test in self.tests.itervalues():
-            status = test.status
-            per_status[status] = per_status.get(status, 0) + 1
+    if not per_status and overall_status == TEST_NONE:
+        return 'Status: No tests found'
 
-        ret = []
-        for status in STATUSES:
-            ret.append('%d %s' % (per_status.get(status, 0),
-                STATUS_NAMES[status]))
+    ret = []
+    for status in STATUSES:
+        ret.append('%d %s' % (per_status.get(status, 0),
+            STATUS_NAMES[status]))
 
-        overall = 'Status: %s' % STATUS_NAMES[self.status].capitalize()
-        return overall + ' - ' + ', '.join(ret)
+    overall = 'Status: %s' % STATUS_NAMES[overall_status].capitalize()
+    return overall + ' - ' + ', '.join(ret)
 
-def processTests(helper, job):
+
+def processTests(helper, job, troves=None):
     '''
     For each built trove configured to extract tests, process those tests
     into JUnit output and return test and coverage data.
 
+    @param troves: If given, process only these build troves from the job.
     @returns: A tuple (test_suite, cover_data)
     '''
 
     test_suite = TestSuite()
     cover_data = {}
 
-    for build_trove in job.iterTroves():
+    if troves is None:
+        troves = job.iterTroves()
+    testinfo = []
+    for build_trove in troves:
         for name, version, flavor in build_trove.iterBuiltTroves():
-            if not name.endswith(':testinfo'):
-                continue
-
+            if name.endswith(':testinfo'):
+                testinfo.append((name, version, flavor))
+    if not testinfo:
+        return test_suite, cover_data
+
+    # Get the file lists of all the testinfo troves at once, then fetch
+    # the contents of only the files we need.
+    cs_job = [(name, (None, None), (version, flavor), True)
+        for (name, version, flavor) in testinfo]
+    changeset = helper.getClient().createChangeSet(cs_job,
+        withFiles=True, withFileContents=False)
+    wanted = {}
+    for trove_cs in changeset.iterNewTroveList():
+        wanted[trove_cs.getNewNameVersionFlavor()] = [
+            (path, fileId, fileVer)
+            for (pathId, path, fileId, fileVer) in trove_cs.getNewFileList()
+            if re_config_output.search(path)
+                or re_test_output.search(path)
+                or re_cover_output.search(path)]
+    to_fetch = [(fileId, fileVer) for nvf in testinfo
+        for (path, fileId, fileVer) in wanted[nvf]]
+    contents = iter(to_fetch and helper.getRepos().getFileContents(to_fetch))
+
+    def iterTroveFiles():
+        for nvf in testinfo:
             configuration = None
             test_fobjs = []
             cover_fobjs = []
-
-            cs_job = [(name, (None, None), (version, flavor), True)]
-            changeset = helper.getClient().createChangeSet(cs_job,
-                withFiles=True, withFileContents=True)
-
-            def getFile(pathId, fileId):
-                cont_item = changeset.getFileContents(pathId, fileId)[1]
-                cont_file = cont_item.get()
-                changeset.reset()
-                return cont_file
-
-            for trove_cs in changeset.iterNewTroveList():
-                for pathId, path, fileId, fileVer in trove_cs.getNewFileList():
-                    if re_config_output.search(path):
-                        configuration = getFile(pathId, fileId).read()
-                    elif re_test_output.search(path):
-                        test_fobjs.append(getFile(pathId, fileId))
-                    elif re_cover_output.search(path):
-                        cover_fobjs.append(getFile(pathId, fileId))
+            for path, fileId, fileVer in wanted[nvf]:
+                fobj = contents.next().get()
+                if re_config_output.search(path):
+                    configuration = fobj.read()
+                elif re_test_output.search(path):
+                    test_fobjs.append(fobj)
+                elif re_cover_output.search(path):
+                    cover_fobjs.append(fobj)
+            yield nvf, configuration, test_fobjs, cover_fobjs
+
+    maxMessageSize = helper.plan.maxTestMessageSize
+    workers = min(helper.plan.testWorkers, len(testinfo))
+    if workers <= 1:
+        for (name, version, flavor), configuration, test_fobjs, cover_fobjs \
+                in iterTroveFiles():
             processTroveTests(test_suite, cover_data, name, version, flavor,
-                configuration, test_fobjs, cover_fobjs)
+                configuration, test_fobjs, cover_fobjs, maxMessageSize)
+        return test_suite, cover_data
+
+    # Spool the result files to disk so that each worker process only
+    # has to be told where to find them, then merge the partial results
+    # in trove order.
+    spool_dir = tempfile.mkdtemp(prefix='bob-tests-')
+    try:
+        tasks = []
+        for (name, version, flavor), configuration, test_fobjs, cover_fobjs \
+                in iterTroveFiles():
+            tasks.append((name, str(version), str(flavor), configuration,
+                [_spoolFile(spool_dir, x) for x in test_fobjs],
+                [_spoolFile(spool_dir, x) for x in cover_fobjs],
+                maxMessageSize))
+
+        pool = multiprocessing.Pool(processes=workers,
+            initializer=resetStopHandlers)
+        try:
+            results = pool.map(_processTroveWorker, tasks, chunksize=1)
+        except:
+            pool.terminate()
+            pool.join()
+            raise
+        pool.close()
+        pool.join()
+    finally:
+        shutil.rmtree(spool_dir)
+
+    for partial_suite, partial_cover in results:
+        test_suite.merge(partial_suite)
+        coverage.merge(cover_data, partial_cover)
 
     return test_suite, cover_data
 
 
+def _spoolFile(spool_dir, fobj):
+    '''
+    Copy the contents of C{fobj} to a new file in C{spool_dir} and
+    return its path.
+    '''
+    fd, path = tempfile.mkstemp(dir=spool_dir)
+    with os.fdopen(fd, 'wb') as out_fobj:
+        shutil.copyfileobj(fobj, out_fobj)
+    return path
+
+
+def _processTroveWorker((name, version, flavor, configuration, test_paths,
+  cover_paths, maxMessageSize)):
+    '''
+    Process the spooled test results of one built trove in a worker
+    process and return a partial C{(test_suite, cover_data)} tuple.
+    '''
+    test_suite = TestSuite()
+    cover_data = {}
+    processTroveTests(test_suite, cover_data, name, version, flavor,
+        configuration, [open(x, 'rb') for x in test_paths],
+        [open(x, 'rb') for x in cover_paths], maxMessageSize)
+    return test_suite, cover_data
+
+
 def processTroveTests(test_suite, cover_data, name, version, flavor,
-  configuration, test_fobjs, cover_fobjs):
+  configuration, test_fobjs, cover_fobjs, maxMessageSize=0):
     '''
     Process tests for a single built trove.
     '''
@@ -358,12 +741,12 @@ def processTroveTests(test_suite, cover_data, name, version, flavor,
     log.debug('Processing tests from %s=%s[%s]', name, version, flavor)
 
     # XXX need a better parser (or format)
-    configuration = HashableDict(eval(configuration))
+    configuration = internConfiguration(eval(configuration))
 
     # Tests
     for test_fobj in test_fobjs:
         try:
-            test_suite.load_junit(test_fobj, configuration)
+            test_suite.load_junit(test_fobj, configuration, maxMessageSize)
         except TestParseError, e:
             log.error('Test parse error in %s=%s[%s]: %s',
                 name, version, flavor, str(e))
@@ -371,20 +754,11 @@ def processTroveTests(test_suite, cover_data, name, version, flavor,
 
     # Coverage
     for cover_fobj in cover_fobjs:
-        coverage.load(cover_data, cover_fobj)
-
-
-def grabXMLData(node):
-    """Collect CDATA from a XML node and all its descendants."""
-    nodes = [node]
-    out = []
-    while nodes:
-        node = nodes.pop(0)
-        for child in node.childNodes:
-            nodes.append(child)
-        if hasattr(node, 'data') and node.data.strip() != '':
-            out.append(node.data)
-    return u''.join(out)
+        try:
+            coverage.load(cover_data, cover_fobj)
+        except coverage.CoverageFormatError, e:
+            log.error('Coverage parse error in %s=%s[%s]: %s',
+                name, version, flavor, str(e))
 
 
 def testLoadJunit():
@@ -0,0 +1,249 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+'''
+Local history of test durations, and reports on slow and slowing tests.
+'''
+
+import heapq
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from conary.lib.util import mkdirChain
+
+log = logging.getLogger('bob.testhistory')
+
+
+# Number of tests listed in the slowest-tests report
+SLOWEST_COUNT = 50
+
+# Runs shorter than this many seconds are too noisy to report as regressions
+MIN_DURATION = 1.0
+
+# Bump when SCHEMA changes; older histories are discarded
+SCHEMA_VERSION = 1
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS runs (
+        run_id      INTEGER PRIMARY KEY AUTOINCREMENT,
+        plan        TEXT NOT NULL,
+        started     REAL NOT NULL
+    )''',
+    '''CREATE INDEX IF NOT EXISTS runs_plan
+        ON runs (plan)''',
+    '''CREATE TABLE IF NOT EXISTS durations (
+        run_id      INTEGER NOT NULL,
+        test        TEXT NOT NULL,
+        config      TEXT NOT NULL,
+        duration    REAL NOT NULL
+    )''',
+    '''CREATE INDEX IF NOT EXISTS durations_run_id
+        ON durations (run_id)''',
+    ]
+
+
+def _configKey(configuration):
+    '''Return a stable string form of a test configuration.'''
+    return json.dumps(configuration, sort_keys=True)
+
+
+def _median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def _iterDurations(test_suite):
+    '''
+    Yield a C{(test, config, duration)} tuple for each run of each test
+    in C{test_suite}.
+    '''
+    for name, case in test_suite.tests.iteritems():
+        for i, configuration in enumerate(case.configurations):
+            yield name, _configKey(configuration), case.durations[i]
+
+
+class TestHistory(object):
+    '''
+    Durations of every test run in each of the last C{keepRuns} bob
+    runs of the plan identified by C{plan}, stored in a sqlite database
+    at C{path}. Several bob processes, and several plans, may share one
+    database; each plan's runs are kept and compared separately.
+    '''
+
+    def __init__(self, path, keepRuns, plan):
+        self.path = path
+        self.keepRuns = keepRuns
+        self.plan = plan
+        mkdirChain(os.path.dirname(path))
+        self.db = sqlite3.connect(path, timeout=60)
+        with self.db:
+            version = self.db.execute('PRAGMA user_version').fetchone()[0]
+            if version != SCHEMA_VERSION:
+                self.db.execute('DROP TABLE IF EXISTS runs')
+                self.db.execute('DROP TABLE IF EXISTS durations')
+            for statement in SCHEMA:
+                self.db.execute(statement)
+            self.db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        self.runId = None
+
+    def close(self):
+        self.db.close()
+
+    def getMedians(self):
+        '''
+        Return a dict mapping C{(test, config)} to the median duration of
+        that test over the plan's runs in the history.
+        '''
+        durations = {}
+        cursor = self.db.execute('''SELECT test, config, duration
+            FROM durations WHERE run_id IN (
+                SELECT run_id FROM runs WHERE plan = ?
+                ORDER BY run_id DESC LIMIT ?)''',
+            (self.plan, self.keepRuns))
+        for test, config, duration in cursor:
+            durations.setdefault((test, config), []).append(duration)
+        return dict((key, _median(values))
+            for (key, values) in durations.iteritems())
+
+    def startRun(self):
+        '''
+        Start a new run to record durations into, and forget the plan's
+        runs older than the last C{keepRuns}.
+        '''
+        with self.db:
+            cursor = self.db.execute(
+                'INSERT INTO runs (plan, started) VALUES (?, ?)',
+                (self.plan, time.time()))
+            self.runId = cursor.lastrowid
+            self.db.execute('''DELETE FROM runs WHERE plan = ?
+                AND run_id NOT IN (
+                    SELECT run_id FROM runs WHERE plan = ?
+                    ORDER BY run_id DESC LIMIT ?)''',
+                (self.plan, self.plan, self.keepRuns))
+            self.db.execute('''DELETE FROM durations WHERE run_id NOT IN (
+                SELECT run_id FROM runs)''')
+
+    def record(self, test_suite):
+        '''
+        Add the durations of all tests in C{test_suite} to the current
+        run.
+        '''
+        if self.runId is None:
+            self.startRun()
+        with self.db:
+            self.db.executemany('''INSERT INTO durations
+                (run_id, test, config, duration) VALUES (?, ?, ?, ?)''',
+                ((self.runId, test, config, duration)
+                    for (test, config, duration)
+                    in _iterDurations(test_suite)))
+
+
+def findRegressions(test_suite, medians, threshold):
+    '''
+    Return a list of C{(test, config, median, duration)} tuples for each
+    test run in C{test_suite} that took more than C{threshold} percent
+    longer than its median duration in C{medians}, slowest growth first.
+    '''
+    regressions = []
+    for test, config, duration in _iterDurations(test_suite):
+        median = medians.get((test, config))
+        if median is None or duration < MIN_DURATION:
+            continue
+        if duration > median * (100 + threshold) / 100.0:
+            regressions.append((test, config, median, duration))
+    regressions.sort(key=_growth, reverse=True)
+    return regressions
+
+
+def _growth((test, config, median, duration)):
+    return (duration - median) / max(median, 0.001)
+
+
+def _write(fileobj, data):
+    '''Write C{data} to C{fileobj}, encoding unicode as UTF-8.'''
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    fileobj.write(data)
+
+
+def writeSlowest(fileobj, runs):
+    '''
+    Write a report of the slowest test runs, given as a list of
+    C{(test, config, duration)} tuples.
+    '''
+    for test, config, duration in runs:
+        _write(fileobj, '%10.3f  %s %s\n' % (duration, test, config))
+
+
+def writeRegressions(fileobj, regressions):
+    '''
+    Write a report of the regressions found by L{findRegressions}.
+    '''
+    for test, config, median, duration in regressions:
+        _write(fileobj, '%10.3f  %10.3f  %+6.0f%%  %s %s\n' % (median,
+            duration, _growth((test, config, median, duration)) * 100,
+            test, config))
+
+
+class DurationReport(object):
+    '''
+    Collect the slowest test runs and the regressions against a
+    L{TestHistory} from a series of L{TestSuite<bob.test.TestSuite>}s,
+    recording each suite in the history as it is added. Only the
+    reports are kept, so the suites can be released once added.
+    '''
+
+    def __init__(self, history, threshold, count=SLOWEST_COUNT):
+        self.history = history
+        self.threshold = threshold
+        self.count = count
+        self.slowest = []
+        self.regressions = []
+        self.medians = history and history.getMedians() or {}
+
+    def add(self, test_suite):
+        '''
+        Add the test runs from C{test_suite} to the reports and the
+        history.
+        '''
+        self.slowest = heapq.nlargest(self.count,
+            itertools.chain(self.slowest, _iterDurations(test_suite)),
+            key=lambda x: x[2])
+        if self.history:
+            self.regressions.extend(findRegressions(test_suite,
+                self.medians, self.threshold))
+            self.history.record(test_suite)
+
+    def write(self, directory):
+        '''
+        Write C{slowest.txt}, and C{regressions.txt} if there is a
+        history, to C{directory}.
+        '''
+        with open(os.path.join(directory, 'slowest.txt'), 'w') as fobj:
+            writeSlowest(fobj, self.slowest)
+        if self.history:
+            self.regressions.sort(key=_growth, reverse=True)
+            with open(os.path.join(directory, 'regressions.txt'),
+                    'w') as fobj:
+                writeRegressions(fobj, self.regressions)
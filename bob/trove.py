@@ -19,6 +19,8 @@
 Internal representation of a build trove
 '''
 
+from StringIO import StringIO
+
 from conary.deps.deps import Flavor
 
 from bob.config import BobTargetSection
@@ -86,10 +88,29 @@ class BobPackage(object):
     # Upstream contents
     def getRecipe(self):
         try:
-            return self.recipeFiles[self.getRecipeName()]
+            return self.getFileContents(self.getRecipeName())
         except KeyError:
             raise RuntimeError("Trove %s recipe is missing!" % (self.name,))
 
+    def openFile(self, name):
+        '''
+        Return a file object for upstream file I{name}, which may be held
+        in memory or spooled to disk.
+        '''
+        contents = self.recipeFiles[name]
+        if isinstance(contents, str):
+            return StringIO(contents)
+        return contents.get()
+
+    def getFileContents(self, name):
+        '''
+        Return the contents of upstream file I{name} as a string.
+        '''
+        contents = self.recipeFiles[name]
+        if isinstance(contents, str):
+            return contents
+        return contents.get().read()
+
     # Downstream version
     def hasDownstreamVersion(self):
         '''
@@ -66,6 +66,7 @@ class ClientHelper(object):
         self._rmakeClient = None
         self._rmakeHelper = None
         self.ephemeralDir = None
+        self.spoolDir = None
 
     def configChanged(self):
         '''
@@ -117,6 +118,22 @@ class ClientHelper(object):
             util.rmtree(self.ephemeralDir)
         self.ephemeralDir = None
 
+    def makeSpoolDir(self):
+        '''
+        Return a directory to hold large upstream files until the run
+        is over.
+        '''
+        if not self.spoolDir:
+            self.spoolDir = tempfile.mkdtemp(prefix='bob-spool-')
+        return self.spoolDir
+
+    def cleanupSpoolDir(self):
+        if not self.spoolDir:
+            return
+        if os.path.isdir(self.spoolDir):
+            util.rmtree(self.spoolDir)
+        self.spoolDir = None
+
     # Passthroughs
     def callClientHook(self, *args):
         '''Call plugin hooks'''
@@ -283,6 +300,15 @@ def popStopHandler():
     return oldHandler
 
 
+def resetStopHandlers():
+    '''
+    Restore the default handler for all "stop" signals. Used in forked
+    worker processes, which must not run the parent's stop handler.
+    '''
+    for signum in _STOP_SIGNALS:
+        signal.signal(signum, signal.SIG_DFL)
+
+
 def reportCommitMap(commitMap):
     '''
     Print out a commit map in the form of a listing of sources and